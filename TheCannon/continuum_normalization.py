@@ -3,6 +3,9 @@ from functools import partial
 import multiprocessing as mp
 import matplotlib.pyplot as plt
 import scipy.optimize as opt
+from scipy import signal
+from .helpers.sharedmem import (SharedArray, blas_thread_env,
+                                limit_blas_threads, blas_threads_per_proc)
 # from joblib import Parallel, delayed
 
 SMALL = 1.0/200
@@ -88,6 +91,70 @@ def _weighted_median(values, weights, quantile):
     return values[indx]
 
 
+def _is_uniform_grid(wl, rtol=1e-6):
+    """ Whether the wavelength grid is increasing with a constant step """
+    if len(wl) < 2:
+        return False
+    dwl = np.diff(wl)
+    step = dwl.mean()
+    return step > 0 and np.all(abs(dwl - step) <= rtol * step)
+
+
+def _gaussian_smooth_convolve(wl, arrays, L, n_sigma):
+    """ Gaussian-weighted sums along the rows of arrays, on a uniform grid
+
+    On a grid with a constant step the truncated kernel is the same for
+    every pixel, so the sums are a 1D convolution along the pixel axis,
+    done by FFT. Sums over pixels that are all zero are set to exactly 0,
+    as in the direct sum, rather than left at the FFT round-off.
+    """
+    step = (wl[-1] - wl[0]) / (len(wl) - 1)
+    half = int(np.floor(n_sigma * L / step))
+    offsets = step * np.arange(-half, half+1)
+    kernel = np.exp(-0.5*offsets**2/L**2)[None, :]
+    npix = len(wl)
+    pix = np.arange(npix)
+    lo = np.clip(pix - half, 0, npix)
+    hi = np.clip(pix + half + 1, 0, npix)
+    out = []
+    for arr in arrays:
+        res = signal.fftconvolve(arr, kernel, mode='same', axes=1)
+        nonzero = np.hstack((np.zeros((arr.shape[0], 1), dtype=int),
+                             np.cumsum(arr != 0, axis=1)))
+        res[(nonzero[:, hi] - nonzero[:, lo]) == 0] = 0.
+        out.append(res)
+    return out
+
+
+def _gaussian_smooth_banded(wl, arrays, L, n_sigma, block_size=256):
+    """ Gaussian-weighted sums along the rows of arrays, on a sorted grid
+
+    The kernel is cut at n_sigma*L, so the weight matrix is banded: for a
+    block of output pixels only the band of input pixels within reach is
+    used, and only that block of the weight matrix is ever formed.
+    """
+    npix = len(wl)
+    lo = np.searchsorted(wl, wl - n_sigma*L, side='left')
+    hi = np.searchsorted(wl, wl + n_sigma*L, side='right')
+    out = [np.zeros(arr.shape) for arr in arrays]
+    for start in range(0, npix, block_size):
+        stop = min(start + block_size, npix)
+        band = slice(lo[start], hi[stop-1])
+        w = np.exp(-0.5*(wl[start:stop,None]-wl[None,band])**2/L**2)
+        w[abs(wl[start:stop,None]-wl[None,band]) > n_sigma*L] = 0.
+        for arr, res in zip(arrays, out):
+            res[:, start:stop] = np.dot(arr[:, band], w.T)
+    return out
+
+
+def _weighted_mean_cont(top, bot):
+    """ Ratio of the smoothed flux*ivar to the smoothed ivar, 0 if no weight """
+    bad = bot == 0
+    cont = np.zeros(top.shape)
+    cont[~bad] = top[~bad] / bot[~bad]
+    return cont
+
+
 def _find_cont_gaussian_smooth(wl, fluxes, ivars, w):
     """ Returns the weighted mean block of spectra
 
@@ -99,8 +166,8 @@ def _find_cont_gaussian_smooth(wl, fluxes, ivars, w):
         block of flux values 
     ivar: numpy ndarray
         block of ivar values
-    L: float
-        width of Gaussian used to assign weights
+    w: numpy ndarray
+        dense Gaussian weight matrix, see gaussian_weight_matrix
 
     Returns
     -------
@@ -110,21 +177,76 @@ def _find_cont_gaussian_smooth(wl, fluxes, ivars, w):
     print("Finding the continuum")
     bot = np.dot(ivars, w.T)
     top = np.dot(fluxes*ivars, w.T)
-    bad = bot == 0
-    cont = np.zeros(top.shape)
-    cont[~bad] = top[~bad] / bot[~bad]
-    return cont
+    return _weighted_mean_cont(top, bot)
 
 
-def _cont_norm_gaussian_smooth(dataset, L):
+def _find_cont_gaussian_smooth_truncated(wl, fluxes, ivars, L, n_sigma=6.,
+                                         backend="auto"):
+    """ Returns the weighted mean block of spectra, for a truncated kernel
+
+    The Gaussian weights are cut at n_sigma*L, so that the npixels by
+    npixels weight matrix is never built.
+
+    Parameters
+    ----------
+    wl: numpy ndarray
+        sorted wavelength vector
+    flux: numpy ndarray
+        block of flux values 
+    ivar: numpy ndarray
+        block of ivar values
+    L: float
+        width of Gaussian used to assign weights
+    n_sigma: float
+        the kernel is cut at n_sigma*L
+    backend: str
+        'convolve' for a grid with a constant wavelength step, 'banded' for
+        any sorted grid, or 'auto' to choose 'convolve' when possible
+
+    Returns
+    -------
+    smoothed_fluxes: numpy ndarray
+        block of smoothed flux values, mean spectra
+    """
+    wl = np.asarray(wl, dtype=float)
+    uniform = _is_uniform_grid(wl)
+    if backend == "auto":
+        backend = "convolve" if uniform else "banded"
+    if backend == "convolve":
+        if not uniform:
+            raise ValueError("convolution needs a constant wavelength step")
+        smooth = _gaussian_smooth_convolve
+    elif backend == "banded":
+        if np.any(np.diff(wl) < 0):
+            raise ValueError("banded smoothing needs a sorted wavelength grid")
+        smooth = _gaussian_smooth_banded
+    else:
+        raise ValueError("unknown smoothing backend: %s" % backend)
+    bot, top = smooth(wl, [ivars, fluxes*ivars], L, n_sigma)
+    return _weighted_mean_cont(top, bot)
+
+
+def _cont_norm_gaussian_smooth(dataset, L, backend="auto", n_sigma=6.,
+                               block_size=1000):
     """ Continuum normalize by dividing by a Gaussian-weighted smoothed spectrum
 
+    The spectra are normalized block by block, so that they can be
+    memory-mapped cubes; the outputs are mapped in dataset.out_dir if set.
+
     Parameters
     ----------
     dataset: Dataset
         the dataset to continuum normalize
     L: float
         the width of the Gaussian used for weighting
+    backend: str
+        'dense' for the full weight matrix, or a backend of
+        _find_cont_gaussian_smooth_truncated; 'auto' by default, as in
+        Dataset.continuum_normalize_gaussian_smoothing
+    n_sigma: float
+        the kernel is cut at n_sigma*L, unless the backend is 'dense'
+    block_size: int
+        number of spectra normalized at once
 
     Returns
     -------
@@ -132,26 +254,86 @@ def _cont_norm_gaussian_smooth(dataset, L):
         updated dataset
     """
     print("Gaussian smoothing the entire dataset...")
-    w = gaussian_weight_matrix(dataset.wl, L)
-
-    print("Gaussian smoothing the training set")
-    cont = _find_cont_gaussian_smooth(
-            dataset.wl, dataset.tr_flux, dataset.tr_ivar, w)
-    norm_tr_flux, norm_tr_ivar = _cont_norm(
-            dataset.tr_flux, dataset.tr_ivar, cont)
-    print("Gaussian smoothing the test set")
-    cont = _find_cont_gaussian_smooth(
-            dataset.wl, dataset.test_flux, dataset.test_ivar, w)
-    norm_test_flux, norm_test_ivar = _cont_norm(
-            dataset.test_flux, dataset.test_ivar, cont)
-    return norm_tr_flux, norm_tr_ivar, norm_test_flux, norm_test_ivar 
-
-
-def _find_cont_fitfunc(fluxes, ivars, contmask, deg, ffunc, n_proc=1):
+    if backend == "dense":
+        w = gaussian_weight_matrix(dataset.wl, L)
+        find_cont = partial(_find_cont_gaussian_smooth, w=w)
+    else:
+        find_cont = partial(_find_cont_gaussian_smooth_truncated, L=L,
+                            n_sigma=n_sigma, backend=backend)
+
+    output = []
+    for which, name in (("tr", "training"), ("test", "test")):
+        print("Gaussian smoothing the %s set" % name)
+        shape = getattr(dataset, which + "_flux").shape
+        norm_flux = dataset._new_array(which + "_flux_norm", shape)
+        norm_ivar = dataset._new_array(which + "_ivar_norm", shape)
+        for start, stop, flux, ivar in dataset.iter_chunks(which, block_size):
+            cont = find_cont(dataset.wl, flux, ivar)
+            norm_flux[start:stop], norm_ivar[start:stop] = _cont_norm(
+                    flux, ivar, cont)
+        output.extend([norm_flux, norm_ivar])
+    return tuple(output)
+
+
+def _cont_design_matrices(contmask, deg, ffunc):
+    """ Basis functions of the continuum, at the continuum and at all pixels
+
+    Chebyshev polynomials are mapped from the range of the continuum pixels
+    to [-1, 1], as by Chebyshev.fit. The sinusoid basis is that of
+    _sinusoid, without its sin(0) term, which is identically zero.
+
+    Parameters
+    ----------
+    contmask: numpy ndarray of length (npixels)
+        boolean pixel mask, True indicates that pixel is continuum 
+
+    deg: int
+        degree of fitting function
+
+    ffunc: str
+        type of fitting function, chebyshev or sinusoid
+
+    Returns
+    -------
+    design: numpy ndarray of shape (ncontpix, nterms)
+        the basis evaluated at the continuum pixels
+    basis: numpy ndarray of shape (npixels, nterms)
+        the basis evaluated at every pixel
+    """
+    pix = np.arange(len(contmask))
+    x = pix[contmask]
+    if ffunc == "chebyshev":
+        domain = np.array([x.min(), x.max()], dtype=float)
+        if domain[0] == domain[1]:
+            domain += [-1, 1]
+        mapped = np.polynomial.polyutils.mapdomain(pix, domain, [-1, 1])
+        basis = np.polynomial.chebyshev.chebvander(mapped, deg)
+    elif ffunc == "sinusoid":
+        L = max(x)-min(x)
+        k = np.arange(deg)*np.pi/L
+        basis = np.empty((len(pix), 2*deg))
+        basis[:, 0::2] = np.sin(k[None, :]*pix[:, None])
+        basis[:, 1::2] = np.cos(k[None, :]*pix[:, None])
+        basis = basis[:, 1:]
+    else:
+        raise ValueError("unknown continuum function: %s" % ffunc)
+    return basis[contmask], basis
+
+
+def _find_cont_fitfunc(fluxes, ivars, contmask, deg, ffunc, n_proc=1,
+                       block_size=1000, pool=None):
     """ Fit a continuum to a continuum pixels in a segment of spectra
 
     Functional form can be either sinusoid or chebyshev, with specified degree
 
+    Both forms are linear in their coefficients, so all stars are fit
+    together by weighted linear least squares on one design matrix, as
+    stacked normal equations, and the continua are a single matrix
+    product with the basis. The weights are those of the per-star fits:
+    Chebyshev.fit(w=ivar) weights the residuals by ivar, and
+    curve_fit(sigma=ivar**-0.5) by sqrt(ivar); pixels with zero ivar get
+    SMALL**2 instead.
+
     Parameters
     ----------
     fluxes: numpy ndarray of shape (nstars, npixels)
@@ -169,59 +351,50 @@ def _find_cont_fitfunc(fluxes, ivars, contmask, deg, ffunc, n_proc=1):
     ffunc: str
         type of fitting function, chebyshev or sinusoid
 
+    n_proc: int
+        number of processes, fitting blocks of stars in parallel
+
+    pool: ContinuumPool, optional
+        worker pool to use instead of starting one with n_proc processes
+
     Returns
     -------
     cont: numpy ndarray of shape (nstars, npixels)
         the continuum, parallel to fluxes
     """
     nstars = fluxes.shape[0]
-    npixels = fluxes.shape[1]
     cont = np.zeros(fluxes.shape)
-
-    if n_proc == 1:
-        for jj in range(nstars):
-            flux = fluxes[jj,:]
-            ivar = ivars[jj,:]
-            pix = np.arange(0, npixels)
-            y = flux[contmask]
-            x = pix[contmask]
-            yivar = ivar[contmask]
-            yivar[yivar == 0] = SMALL**2
-            if ffunc=="sinusoid":
-                p0 = np.ones(deg*2) # one for cos, one for sin
-                L = max(x)-min(x)
-                pcont_func = _partial_func(_sinusoid, L=L, y=flux)
-                popt, pcov = opt.curve_fit(pcont_func, x, y, p0=p0,
-                                           sigma=1./np.sqrt(yivar))
-            elif ffunc=="chebyshev":
-                fit = np.polynomial.chebyshev.Chebyshev.fit(x=x,y=y,w=yivar,deg=deg)
-            for element in pix:
-                if ffunc=="sinusoid":
-                    cont[jj,element] = _sinusoid(element, popt, L=L, y=flux)
-                elif ffunc=="chebyshev":
-                    cont[jj,element] = fit(element)
-    else:
-        # start mp.Pool
-        pool = mp.Pool(processes=n_proc)
-        mp_results = []
-        for i in xrange(nstars):
-            mp_results.append(pool.apply_async(\
-                _find_cont_fitfunc,
-                (fluxes[i, :].reshape((1, -1)),
-                 ivars[i, :].reshape((1, -1)),
-                 contmask[:]),
-                {'deg':deg, 'ffunc':ffunc}))
-        # close mp.Pool
-        pool.close()
-        pool.join()
-
-        cont = np.array([mp_results[i].get().flatten() for i in xrange(nstars)])
-
+    contmask = np.asarray(contmask, dtype=bool)
+    design, basis = _cont_design_matrices(contmask, deg, ffunc)
+    nterms = design.shape[1]
+    design_outer = (design[:, :, None] * design[:, None, :]).reshape(
+            len(design), nterms*nterms)
+
+    if n_proc > 1 or pool is not None:
+        return _find_cont_parallel(
+                "fitfunc", fluxes, ivars, contmask, [[0, len(contmask)]],
+                n_proc=n_proc, pool=pool, deg=deg, ffunc=ffunc)
+    for start in range(0, nstars, block_size):
+        stop = min(start + block_size, nstars)
+        y = fluxes[start:stop, contmask]
+        yivar = ivars[start:stop, contmask]
+        yivar = np.where(yivar == 0, SMALL**2, yivar)
+        if ffunc == "chebyshev":
+            weights = yivar**2
+        else:
+            weights = yivar
+        ATA = np.dot(weights, design_outer).reshape(-1, nterms, nterms)
+        ATy = np.dot(weights * y, design)
+        # scale the columns to unit diagonal before solving
+        scl = np.sqrt(np.diagonal(ATA, axis1=1, axis2=2))
+        ATA = ATA / scl[:, :, None] / scl[:, None, :]
+        coeffs = np.linalg.solve(ATA, (ATy / scl)[:, :, None])[:, :, 0]
+        cont[start:stop] = np.dot(coeffs / scl, basis.T)
     return cont
 
 
 def _find_cont_fitfunc_regions(fluxes, ivars, contmask, deg, ranges, ffunc,
-                               n_proc=1):
+                               n_proc=1, pool=None):
     """ Run fit_cont, dealing with spectrum in regions or chunks
 
     This is useful if a spectrum has gaps.
@@ -243,31 +416,90 @@ def _find_cont_fitfunc_regions(fluxes, ivars, contmask, deg, ranges, ffunc,
     ffunc: str
         type of fitting function, chebyshev or sinusoid
 
+    n_proc: int
+        number of processes; each fits all regions of a block of stars
+
+    pool: ContinuumPool, optional
+        worker pool to use instead of starting one with n_proc processes
+
     Returns
     -------
     cont: numpy ndarray of shape (nstars, npixels)
         the continuum, parallel to fluxes
     """
-    nstars = fluxes.shape[0]
-    npixels = fluxes.shape[1]
+    if n_proc > 1 or pool is not None:
+        return _find_cont_parallel(
+                "fitfunc", fluxes, ivars, contmask, ranges, n_proc=n_proc,
+                pool=pool, deg=deg, ffunc=ffunc)
     cont = np.zeros(fluxes.shape)
     for chunk in ranges:
         start = chunk[0]
         stop = chunk[1]
-        if ffunc=="chebyshev":
-            output = _find_cont_fitfunc(fluxes[:,start:stop],
-                                        ivars[:,start:stop],
-                                        contmask[start:stop],
-                                        deg=deg, ffunc="chebyshev",
-                                        n_proc=n_proc)
-        elif ffunc=="sinusoid":
-            output = _find_cont_fitfunc(fluxes[:,start:stop],
-                                        ivars[:,start:stop],
-                                        contmask[start:stop],
-                                        deg=deg, ffunc="sinusoid",
-                                        n_proc=n_proc)
-        cont[:, start:stop] = output
+        cont[:, start:stop] = _find_cont_fitfunc(
+                fluxes[:,start:stop], ivars[:,start:stop],
+                contmask[start:stop], deg=deg, ffunc=ffunc)
+    return cont
+
+
+def _running_window_bounds(wl, delta_lambda):
+    """ Bounds of the window abs(wl-lam) < delta_lambda around each pixel
+
+    The wavelength grid must be sorted, so that every window is a
+    contiguous run of pixels [lo, hi). The bounds found by searchsorted
+    are corrected against the exact predicate, so that rounding at the
+    window edges selects the same pixels as a full scan.
+
+    Parameters
+    ----------
+    wl: numpy ndarray
+        sorted wavelength vector
+    delta_lambda: float
+        half-width of the window
 
+    Returns
+    -------
+    lo, hi: numpy ndarrays of ints, length (npixels)
+        the window around pixel ll is wl[lo[ll]:hi[ll]]
+    """
+    npix = len(wl)
+    inside = lambda ii, ll: abs(wl[np.clip(ii, 0, npix-1)] - wl[ll]) \
+                            < delta_lambda
+    pix = np.arange(npix)
+    lo = np.searchsorted(wl, wl - delta_lambda, side='left')
+    hi = np.searchsorted(wl, wl + delta_lambda, side='right')
+    while True:
+        grow = (lo > 0) & inside(lo-1, pix)
+        shrink = ~grow & (lo < pix) & ~inside(lo, pix)
+        if not (grow.any() or shrink.any()):
+            break
+        lo = lo - grow + shrink
+    while True:
+        grow = (hi < npix) & inside(hi, pix)
+        shrink = ~grow & (hi > pix+1) & ~inside(hi-1, pix)
+        if not (grow.any() or shrink.any()):
+            break
+        hi = hi + grow - shrink
+    return lo, hi
+
+
+def _find_cont_running_quantile_scan(wl, fluxes, ivars, q, delta_lambda,
+                                     verbose=False):
+    """ Running quantile by a full scan for each pixel, for unsorted grids
+
+    Same parameters and output as _find_cont_running_quantile
+    """
+    cont = np.zeros(fluxes.shape)
+    nstars = fluxes.shape[0]
+    for jj in range(nstars):
+        if verbose:
+            print("cont_norm_q(): working on star [%s/%s]..." % (jj+1, nstars))
+        flux = fluxes[jj,:]
+        ivar = ivars[jj,:]
+        for ll, lam in enumerate(wl):
+            indx = (np.where(abs(wl-lam) < delta_lambda))[0]
+            flux_cut = flux[indx]
+            ivar_cut = ivar[indx]
+            cont[jj, ll] = _weighted_median(flux_cut, ivar_cut, q)
     return cont
 
 
@@ -275,6 +507,12 @@ def _find_cont_running_quantile(wl, fluxes, ivars, q, delta_lambda,
                                 verbose=False):
     """ Perform continuum normalization using a running quantile
 
+    The window slides along the sorted wavelength grid, and for all stars
+    at once a sorted copy of it is kept up to date: the pixels leaving the
+    window are deleted from it and those entering it are inserted, instead
+    of sorting every window from scratch. The weighted quantile of each
+    window is then the same as that of _weighted_median.
+
     Parameters
     ----------
     wl: numpy ndarray 
@@ -290,23 +528,71 @@ def _find_cont_running_quantile(wl, fluxes, ivars, q, delta_lambda,
 
     Output
     ------
-    norm_fluxes: numpy ndarray of shape (nstars, npixels)
-        normalized pixel intensities
-    norm_ivars: numpy ndarray of shape (nstars, npixels)
-        rescaled pixel invariances
+    cont: numpy ndarray of shape (nstars, npixels)
+        the continuum, parallel to fluxes
     """
+    wl = np.asarray(wl)
+    fluxes = np.atleast_2d(fluxes)
+    ivars = np.atleast_2d(ivars)
+    if np.any(np.diff(wl) < 0):
+        return _find_cont_running_quantile_scan(
+                wl, fluxes, ivars, q, delta_lambda, verbose=verbose)
+    nstars, npix = fluxes.shape
     cont = np.zeros(fluxes.shape)
-    nstars = fluxes.shape[0]
-    for jj in range(nstars):
-        if verbose:
-            print("cont_norm_q(): working on star [%s/%s]..." % (jj+1, nstars))
-        flux = fluxes[jj,:]
-        ivar = ivars[jj,:]
-        for ll, lam in enumerate(wl):
-            indx = (np.where(abs(wl-lam) < delta_lambda))[0]
-            flux_cut = flux[indx]
-            ivar_cut = ivar[indx]
-            cont[jj, ll] = _weighted_median(flux_cut, ivar_cut, q)
+    if verbose:
+        print("cont_norm_q(): working on %s stars..." % nstars)
+    if nstars == 0 or npix == 0:
+        return cont
+
+    # rank of every pixel in its sorted spectrum; the sorted window is
+    # kept as an array of ranks, padded at the end with npix
+    order = np.argsort(fluxes, axis=1, kind='mergesort')
+    rank = np.empty(order.shape, dtype=int)
+    np.put_along_axis(rank, order, np.arange(npix)[None, :], axis=1)
+    sorted_fluxes = np.take_along_axis(fluxes, order, axis=1)
+    sorted_ivars = np.take_along_axis(ivars, order, axis=1)
+
+    lo, hi = _running_window_bounds(wl, delta_lambda)
+    width = int((hi - lo).max())
+    cols = np.arange(width)
+    pad = np.full((nstars, 1), npix)
+    window = np.full((nstars, width), npix)
+    stars = np.arange(nstars)
+
+    def delete(window, r):
+        pos = (window < r[:, None]).sum(axis=1)
+        shifted = np.hstack((window[:, 1:], pad))
+        return np.where(cols >= pos[:, None], shifted, window)
+
+    def insert(window, r):
+        pos = (window < r[:, None]).sum(axis=1)
+        shifted = np.hstack((pad, window[:, :-1]))
+        window = np.where(cols < pos[:, None], window, shifted)
+        window[stars, pos] = r
+        return window
+
+    window_lo, window_hi = lo[0], lo[0]
+    for ll in range(npix):
+        for ii in range(window_lo, min(lo[ll], window_hi)):
+            window = delete(window, rank[:, ii])
+        for ii in range(max(window_hi, lo[ll]), hi[ll]):
+            window = insert(window, rank[:, ii])
+        window_lo, window_hi = lo[ll], hi[ll]
+        m = hi[ll] - lo[ll]
+        if m == 0:
+            # as in _weighted_median, an empty window has no quantile
+            raise IndexError("empty running quantile window at pixel %s" % ll)
+        ranks = window[:, :m]
+        cvalues = np.cumsum(
+                np.take_along_axis(sorted_ivars, ranks, axis=1), axis=1)
+        total = cvalues[:, -1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            above = cvalues / total[:, None] > q
+        found = above.any(axis=1) & (total != 0)
+        first = np.argmax(above, axis=1)
+        cont[:, ll] = np.where(
+                found, sorted_fluxes[stars, ranks[stars, first]],
+                fluxes[:, lo[ll]])
     return cont
 
 
@@ -316,10 +602,12 @@ def _find_cont_running_quantile(wl, fluxes, ivars, q, delta_lambda,
 # continuum_normalize_training_q()
 # |- _cont_norm_running_quantile()
 #    |- _find_cont_running_quantile()
-#    |- _find_cont_running_quantile_mp()
+# |- _cont_norm_running_quantile_mp()
+#    |- ContinuumPool.find_cont()
 # |- _cont_norm_running_quantile_regions
 #    |- _cont_norm_running_quantile
-#    |- _cont_norm_running_quantile_mp()
+# |- _cont_norm_running_quantile_regions_mp()
+#    |- ContinuumPool.find_cont(), all chunks in one pass
 #
 # the basic running_quantile method:
 # _find_cont_running_quantile()
@@ -335,47 +623,22 @@ def _cont_norm_running_quantile(wl, fluxes, ivars, q, delta_lambda, verbose=True
     return norm_fluxes, norm_ivars
 
 def _cont_norm_running_quantile_mp(wl, fluxes, ivars, q, delta_lambda,
-                                   n_proc=2, verbose=False):
+                                   n_proc=2, verbose=False, pool=None):
     """
     The same as _cont_norm_running_quantile() above,
     but using multi-processing.
 
+    Blocks of stars are normalized by a ContinuumPool.
+
     Bo Zhang (NAOC)
     """
-    nStar = fluxes.shape[0]
-
-    # start mp.Pool
-    mp_results = []
-    pool = mp.Pool(processes=n_proc)
-    for i in xrange(nStar):
-        mp_results.append(pool.apply_async(\
-            _find_cont_running_quantile,
-            (wl, fluxes[i, :].reshape((1, -1)), ivars[i, :].reshape((1, -1)),
-             q, delta_lambda), {'verbose': False}))
-        if verbose:
-            print('@Bo Zhang: continuum normalizing star [%d/%d] ...'\
-                  % (i + 1, nStar))
-    # close mp.Pool
-    pool.close()
-    pool.join()
-
-    # reshape results --> cont
-    cont = np.zeros_like(fluxes)
-    for i in xrange(nStar):
-        cont[i, :] = mp_results[i].get() #.flatten()
-    norm_fluxes = np.ones(fluxes.shape)
-    norm_fluxes[cont!=0] = fluxes[cont!=0] / cont[cont!=0]
-    norm_ivars = cont**2 * ivars
-
+    cont = _find_cont_parallel(
+            "quantile", fluxes, ivars, wl, [[0, len(wl)]], n_proc=n_proc,
+            pool=pool, verbose=verbose, q=q, delta_lambda=delta_lambda)
+    norm_fluxes, norm_ivars = _cont_norm(fluxes, ivars, cont)
     print('@Bo Zhang: continuum normalization finished!')
     return norm_fluxes, norm_ivars
 
-    # if use joblib
-    # mp_results = Parallel(n_jobs=n_proc)\
-    #     (delayed(_find_cont_running_quantile)\
-    #          (wl, fluxes[i, :].reshape((1, -1)), ivars[i, :].reshape((1, -1)), q, delta_lambda, False, True) for i in range(nStar))
-    # return mp_results
-
 
 def _cont_norm_running_quantile_regions(wl, fluxes, ivars, q, delta_lambda,
                                         ranges, verbose=True):
@@ -399,38 +662,169 @@ def _cont_norm_running_quantile_regions(wl, fluxes, ivars, q, delta_lambda,
 
 
 def _cont_norm_running_quantile_regions_mp(wl, fluxes, ivars, q, delta_lambda,
-                                           ranges, n_proc=2, verbose=False):
+                                           ranges, n_proc=2, verbose=False,
+                                           pool=None):
     """
     Perform continuum normalization using running quantile, for spectrum
     that comes in chunks.
 
     The same as _cont_norm_running_quantile_regions(),
-    but using multi-processing.
+    but using multi-processing: each block of stars is normalized in all
+    chunks by one task of a ContinuumPool.
 
     Bo Zhang (NAOC)
     """
     print("contnorm.py: continuum norm using running quantile")
     print("Taking spectra in %s chunks" % len(ranges))
-    # nstars = fluxes.shape[0]
-    nchunks = len(ranges)
+    cont = _find_cont_parallel(
+            "quantile", fluxes, ivars, wl, ranges, n_proc=n_proc, pool=pool,
+            verbose=verbose, q=q, delta_lambda=delta_lambda)
     norm_fluxes = np.zeros(fluxes.shape)
     norm_ivars = np.zeros(ivars.shape)
-    for i in xrange(nchunks):
-        chunk = ranges[i, :]
+    for chunk in ranges:
         start = chunk[0]
         stop = chunk[1]
-        if verbose:
-            print('@Bo Zhang: Going to normalize Chunk [%d/%d], pixel:[%d, %d] ...'
-                  % (i+1, nchunks, start, stop))
-        output = _cont_norm_running_quantile_mp(
-            wl[start:stop], fluxes[:, start:stop],
-            ivars[:, start:stop], q, delta_lambda,
-            n_proc=n_proc, verbose=verbose)
+        output = _cont_norm(fluxes[:, start:stop], ivars[:, start:stop],
+                            cont[:, start:stop])
         norm_fluxes[:, start:stop] = output[0]
         norm_ivars[:, start:stop] = output[1]
+    print('@Bo Zhang: continuum normalization finished!')
     return norm_fluxes, norm_ivars
 
 
+####################################################
+# worker pool for the multi-process continuum normalization
+#
+# The spectra are copied once into shared arrays, which the workers map;
+# each task is a block of stars, for which the worker finds the continuum
+# in every chunk and writes it into a shared output array.
+####################################################
+
+
+def _find_cont_block(task):
+    """ Find the continuum of a block of stars in all chunks
+
+    The shared arrays of the job are mapped for this task only, so that no
+    worker holds on to those of a finished job, whose space is then freed
+    as soon as the job releases them.
+    """
+    specs, method, start, stop, ranges, kwargs = task
+    shared = dict((key, SharedArray.attach(spec).array)
+                  for key, spec in specs.items())
+    fluxes = shared['fluxes'][start:stop]
+    ivars = shared['ivars'][start:stop]
+    grid = shared['grid']
+    cont = shared['cont']
+    for lo, hi in ranges:
+        if method == "quantile":
+            cont[start:stop, lo:hi] = _find_cont_running_quantile(
+                    grid[lo:hi], fluxes[:, lo:hi], ivars[:, lo:hi], **kwargs)
+        else:
+            cont[start:stop, lo:hi] = _find_cont_fitfunc(
+                    fluxes[:, lo:hi], ivars[:, lo:hi], grid[lo:hi], **kwargs)
+    return start, stop
+
+
+class ContinuumPool(object):
+    """ Worker processes for continuum normalization, reused between calls
+
+    Parameters
+    ----------
+    n_proc: int
+        number of worker processes
+    block_size: int
+        largest number of stars in one task
+
+    Use as a context manager, or call close() when done, e.g.
+
+        with ContinuumPool(4) as pool:
+            tr_cont = _find_cont_fitfunc(tr_flux, tr_ivar, contmask, 3,
+                                         "chebyshev", pool=pool)
+            test_cont = ...
+    """
+    def __init__(self, n_proc, block_size=500):
+        self.n_proc = n_proc
+        self.block_size = block_size
+        blas_threads = blas_threads_per_proc(n_proc)
+        with blas_thread_env(blas_threads):
+            self._pool = mp.Pool(processes=n_proc,
+                                 initializer=limit_blas_threads,
+                                 initargs=(blas_threads, ))
+
+    def find_cont(self, method, fluxes, ivars, grid, ranges, verbose=False,
+                  **kwargs):
+        """ The continuum of every star, in every chunk
+
+        Parameters
+        ----------
+        method: str
+            'quantile' for _find_cont_running_quantile, with grid the
+            wavelengths, or 'fitfunc' for _find_cont_fitfunc, with grid
+            the continuum mask
+        fluxes: numpy ndarray of shape (nstars, npixels)
+            pixel intensities
+        ivars: numpy ndarray of shape (nstars, npixels)
+            inverse variances, parallel to fluxes
+        grid: numpy ndarray of length (npixels)
+            wavelengths or continuum mask
+        ranges: list or np ndarray
+            the chunks that the spectrum should be split into
+        kwargs:
+            passed on to the continuum function
+
+        Returns
+        -------
+        cont: numpy ndarray of shape (nstars, npixels)
+            the continuum, zero outside of the chunks
+        """
+        nstars = fluxes.shape[0]
+        ranges = [(int(lo), int(hi)) for lo, hi in ranges]
+        # a few tasks per worker, so that they finish together
+        block_size = max(1, min(self.block_size,
+                                -(-nstars // (4 * self.n_proc))))
+        shared = {'fluxes': SharedArray.copy_of(fluxes),
+                  'ivars': SharedArray.copy_of(ivars),
+                  'grid': SharedArray.copy_of(grid),
+                  'cont': SharedArray(fluxes.shape)}
+        try:
+            specs = dict((key, val.spec) for key, val in shared.items())
+            tasks = [(specs, method, start, min(start + block_size, nstars),
+                      ranges, kwargs)
+                     for start in range(0, nstars, block_size)]
+            for start, stop in self._pool.imap_unordered(
+                    _find_cont_block, tasks):
+                if verbose:
+                    print("continuum normalized stars [%d:%d] of %d"
+                          % (start, stop, nstars))
+            cont = np.array(shared['cont'].array)
+        finally:
+            for val in shared.values():
+                val.release()
+        return cont
+
+    def close(self):
+        """ Stop the worker processes """
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _find_cont_parallel(method, fluxes, ivars, grid, ranges, n_proc=2,
+                        pool=None, verbose=False, **kwargs):
+    """ ContinuumPool.find_cont, in a given pool or in a new one """
+    if pool is not None:
+        return pool.find_cont(method, fluxes, ivars, grid, ranges,
+                              verbose=verbose, **kwargs)
+    with ContinuumPool(n_proc) as pool:
+        return pool.find_cont(method, fluxes, ivars, grid, ranges,
+                              verbose=verbose, **kwargs)
+
+
 def _cont_norm(fluxes, ivars, cont):
     """ Continuum-normalize a continuous segment of spectra.
 
@@ -8,6 +8,7 @@ rc('text', usetex=True)
 rc('font', family='serif')
 from .helpers.corner import corner
 from .helpers import Table
+from .helpers.cubes import load_cube, new_array, iter_blocks
 from .find_continuum_pixels import * 
 from .continuum_normalization import \
     (_cont_norm_gaussian_smooth,
@@ -18,7 +19,8 @@ from .continuum_normalization import \
      _find_cont_fitfunc,
      _find_cont_fitfunc_regions,
      _cont_norm,
-     _cont_norm_regions)
+     _cont_norm_regions,
+     ContinuumPool)
 from .find_continuum_pixels import _find_contpix,_find_contpix_regions
 from multiprocessing import cpu_count
 from astropy.io import fits
@@ -34,12 +36,80 @@ else:
     basestring = (str, unicode)
 
 
+def _SNRs(fluxes, ivars, block_size=1000):
+    """ The SNR of each spectrum, ignoring bad pixels, as in Dataset._SNR
+
+    The median of flux*sqrt(ivar) over the pixels with ivar > 0 is taken
+    for a block of spectra at once, from the sorted rows with the bad
+    pixels moved to the end. Continuum normalization scales flux and
+    sqrt(ivar) inversely, so it leaves the SNR unchanged.
+
+    Parameters
+    ----------
+    fluxes: numpy ndarray of shape (nstars, npixels)
+        pixel intensities
+    ivars: numpy ndarray of shape (nstars, npixels)
+        inverse variances, parallel to fluxes
+
+    Returns
+    -------
+    SNRs: numpy ndarray of length nstars
+        nan for a spectrum without good pixels
+    """
+    nstars = len(fluxes)
+    SNRs = np.zeros(nstars)
+    for start in range(0, nstars, block_size):
+        flux = np.asarray(fluxes[start:start+block_size])
+        ivar = np.asarray(ivars[start:start+block_size])
+        take = ivar > 0
+        with np.errstate(invalid='ignore'):
+            snr = np.where(take, flux*(np.abs(ivar)**0.5), np.inf)
+        ngood = take.sum(axis=1)
+        snr.sort(axis=1)
+        rows = np.arange(len(snr))
+        lower = snr[rows, np.maximum(ngood-1, 0)//2]
+        upper = snr[rows, np.maximum(ngood, 1)//2]
+        median = np.where(ngood % 2 == 1, lower, (lower+upper)/2)
+        # as np.median, nan if there are no good pixels or a nan among them
+        bad = (ngood == 0) | np.isnan(np.where(take, flux, 0)).any(axis=1)
+        median[bad] = np.nan
+        SNRs[start:start+block_size] = median
+    return SNRs
+
+
+def _cube_property(which, name):
+    """ A flux or ivar cube of a Dataset, e.g. tr_flux
+
+    Replacing the cube first calculates the SNRs of its set from the cubes
+    being replaced, if they are still due, so that they are those of the
+    spectra the Dataset was built with and no reference to the old cubes
+    is kept.
+    """
+    attr = "_%s_%s" % (which, name)
+
+    def fget(self):
+        return getattr(self, attr)
+
+    def fset(self, cube):
+        if getattr(self, attr, cube) is not cube and \
+                getattr(self, "_%s_SNR" % which) is None:
+            getattr(self, which + "_SNR")
+        setattr(self, attr, cube)
+
+    return property(fget, fset, doc="the %s_%s cube" % (which, name))
+
+
 class Dataset(object):
     """ A class to represent Cannon input: a dataset of spectra and labels """
 
-    def __init__(self, wl, tr_ID, tr_flux, tr_ivar, tr_label, test_ID, test_flux, test_ivar):
+    def __init__(self, wl, tr_ID, tr_flux, tr_ivar, tr_label, test_ID, test_flux, test_ivar,
+                 out_dir=None):
         """ Initiate a Dataset object
 
+        The flux and ivar cubes can be numpy arrays, np.memmap arrays or
+        paths of .npy files, which are memory-mapped; the large operations
+        work through them in blocks of stars.
+
         Parameters
         ----------
         wl: grid of wavelength values, onto which all spectra are mapped
@@ -50,25 +120,122 @@ class Dataset(object):
         test_ID: array [nobj[ of IDs of test objects
         test_flux: array [nobj, npix] of flux values for test objects
         test_ivar: array [nobj, npix] of inverse variance values for test objects
+        out_dir: directory in which the outputs of the block-wise operations,
+            e.g. the normalized cubes, are memory-mapped; in memory if None
         """
         print("Loading dataset")
-        print("This may take a while...")
+        # the SNRs are calculated when first used, or from the cubes given
+        # here when they are replaced, e.g. by normalized ones
+        self._tr_SNR = None
+        self._test_SNR = None
         self.wl = wl
         self.tr_ID = tr_ID
-        self.tr_flux = tr_flux
-        self.tr_ivar = tr_ivar
+        self.tr_flux = load_cube(tr_flux)
+        self.tr_ivar = load_cube(tr_ivar)
         self.tr_label = tr_label
         self.test_ID = test_ID
-        self.test_flux = test_flux
-        self.test_ivar = test_ivar
+        self.test_flux = load_cube(test_flux)
+        self.test_ivar = load_cube(test_ivar)
+        self.out_dir = out_dir
         self._label_names = None
         self.ranges = None
-        
-        # calculate SNR
-        self.tr_SNR = np.array(
-                [self._SNR(*s) for s in zip(tr_flux, tr_ivar)])
-        self.test_SNR = np.array(
-                [self._SNR(*s) for s in zip(test_flux, test_ivar)])
+
+
+    tr_flux = _cube_property("tr", "flux")
+    tr_ivar = _cube_property("tr", "ivar")
+    test_flux = _cube_property("test", "flux")
+    test_ivar = _cube_property("test", "ivar")
+
+
+    @property
+    def tr_SNR(self):
+        """ SNR of the training spectra, calculated on first access """
+        if self._tr_SNR is None:
+            self._tr_SNR = _SNRs(self.tr_flux, self.tr_ivar)
+        return self._tr_SNR
+
+
+    @tr_SNR.setter
+    def tr_SNR(self, vals):
+        self._tr_SNR = vals
+
+
+    @property
+    def test_SNR(self):
+        """ SNR of the test spectra, calculated on first access """
+        if self._test_SNR is None:
+            self._test_SNR = _SNRs(self.test_flux, self.test_ivar)
+        return self._test_SNR
+
+
+    @test_SNR.setter
+    def test_SNR(self, vals):
+        self._test_SNR = vals
+
+
+    @classmethod
+    def from_store(cls, store, tr_ID, tr_label, test_ID=None, night=None,
+                   out_dir=None):
+        """ A Dataset of spectra read from a SpectralStore
+
+        The training spectra are fetched by ID. The test set is the rows of
+        the given IDs, or of a night, which stay memory-mapped views of the
+        store, or by default all the rows of the store.
+
+        Parameters
+        ----------
+        store: SpectralStore
+            the store of spectra
+        tr_ID: array of IDs of training objects
+        tr_label: array [nobj, nlabel]
+        test_ID: array of IDs of test objects, optional
+        night: name of the night to use as test set, optional
+        out_dir: see Dataset
+
+        Returns
+        -------
+        dataset: Dataset
+        """
+        tr_flux, tr_ivar, tr_mask = store.fetch(tr_ID)
+        if test_ID is not None:
+            test_flux, test_ivar, test_mask = store.fetch(test_ID)
+        else:
+            rows = slice(None) if night is None else store.night_rows(night)
+            test_ID = store.ids[rows]
+            test_flux = store.flux[rows]
+            test_ivar = store.ivar[rows]
+        return cls(store.wl, np.asarray(tr_ID), tr_flux, tr_ivar, tr_label,
+                   np.asarray(test_ID), test_flux, test_ivar,
+                   out_dir=out_dir)
+
+
+    def iter_chunks(self, which="test", block_size=1000):
+        """ Iterate over blocks of spectra, read into memory one at a time
+
+        Parameters
+        ----------
+        which: str
+            'tr' for the training set, 'test' for the test set
+        block_size: int
+            the number of spectra in a block
+
+        Yields
+        ------
+        start, stop: int
+            the rows of the block
+        flux, ivar: ndarray
+            flux and ivar of the block, [stop-start, npix]
+        """
+        fluxes = getattr(self, which + "_flux")
+        ivars = getattr(self, which + "_ivar")
+        for start, stop in iter_blocks(len(fluxes), block_size):
+            yield (start, stop, np.asarray(fluxes[start:stop]),
+                   np.asarray(ivars[start:stop]))
+
+
+    def _new_array(self, name, shape):
+        """ An output array, memory-mapped as name.npy in out_dir if set """
+        return new_array(shape, self.out_dir, name)
 
 
     def _SNR(self, flux, ivar):
@@ -259,7 +426,7 @@ class Dataset(object):
         self.contmask = contmask
 
 
-    def fit_continuum(self, deg, ffunc, n_proc=1):
+    def fit_continuum(self, deg, ffunc, n_proc=1, block_size=1000):
         """ Fit a continuum to the continuum pixels
 
         Parameters
@@ -268,6 +435,10 @@ class Dataset(object):
             Degree of the fitting function
         ffunc: str
             Type of fitting function, 'sinusoid' or 'chebyshev'
+        n_proc: int
+            Number of processes fitting blocks of stars in parallel
+        block_size: int
+            Number of spectra read and fit at once
 
         Returns
         -------
@@ -277,26 +448,35 @@ class Dataset(object):
             Flux values corresponding to the fitted continuum of test objects
         """
         print("Fitting Continuum...")
-        if self.ranges == None:
-            tr_cont = _find_cont_fitfunc(
-                self.tr_flux, self.tr_ivar, self.contmask, deg, ffunc,
-                n_proc=n_proc)
-            test_cont = _find_cont_fitfunc(
-                self.test_flux, self.test_ivar, self.contmask, deg, ffunc,
-                n_proc=n_proc)
-        else:
+        if self.ranges is not None:
             print("Fitting Continuum in %s Regions..." %len(self.ranges))
-            tr_cont = _find_cont_fitfunc_regions(
-                self.tr_flux, self.tr_ivar, self.contmask, deg, self.ranges,
-                ffunc, n_proc=n_proc)
-            test_cont = _find_cont_fitfunc_regions(
-                self.test_flux, self.test_ivar, self.contmask, deg, self.ranges,
-                ffunc, n_proc=n_proc)
+        # one pool of workers, if any, for both the tr and the test set
+        pool = ContinuumPool(n_proc) if n_proc > 1 else None
+        output = []
+        try:
+            for which in ("tr", "test"):
+                cont = self._new_array(which + "_cont",
+                                       getattr(self, which + "_flux").shape)
+                for start, stop, flux, ivar in self.iter_chunks(
+                        which, block_size):
+                    if self.ranges is None:
+                        cont[start:stop] = _find_cont_fitfunc(
+                            flux, ivar, self.contmask, deg, ffunc, pool=pool)
+                    else:
+                        cont[start:stop] = _find_cont_fitfunc_regions(
+                            flux, ivar, self.contmask, deg, self.ranges,
+                            ffunc, pool=pool)
+                output.append(cont)
+        finally:
+            if pool is not None:
+                pool.close()
+        tr_cont, test_cont = output
         return tr_cont, test_cont
 
 
     def continuum_normalize_training_q(self, q, delta_lambda,
-                                       n_proc=1, verbose=True):
+                                       n_proc=1, verbose=True,
+                                       block_size=1000):
         """ Continuum normalize the training set using a running quantile
 
         Parameters
@@ -305,6 +485,15 @@ class Dataset(object):
             The quantile cut
         delta_lambda: float
             The width of the pixel range used to calculate the median
+        block_size: int
+            Number of spectra read and normalized at once
+
+        Returns
+        -------
+        norm_tr_flux: ndarray
+            Normalized flux values for the training objects
+        norm_tr_ivar: ndarray
+            Rescaled inverse variance values for the training objects
 
 
         Modified by:
@@ -326,35 +515,48 @@ class Dataset(object):
             print('@Bo Zhang: you will use only 1 process ...')
             print('           i.e., the original TheCannon version')
             print('##########################################################')
-            if self.ranges is None:
-                return _cont_norm_running_quantile(
-                    self.wl, self.tr_flux, self.tr_ivar,
-                    q=q, delta_lambda=delta_lambda,
-                    verbose=verbose)
-            else:
-                return _cont_norm_running_quantile_regions(
-                    self.wl, self.tr_flux, self.tr_ivar,
-                    q=q, delta_lambda=delta_lambda,
-                    ranges=self.ranges, verbose=verbose)
         else:
             # use new version (multi process)
             print('##########################################################')
             print('@Bo Zhang: you will use ** %d ** processes ... ' % n_proc)
             print('Note: Multiprocessing calls for more memory on computer!')
             print('##########################################################')
-            if self.ranges is None:
-                return _cont_norm_running_quantile_mp(
-                    self.wl, self.tr_flux, self.tr_ivar,
-                    q=q, delta_lambda=delta_lambda,
-                    n_proc=n_proc, verbose=verbose)
-            else:
-                return _cont_norm_running_quantile_regions_mp(
-                    self.wl, self.tr_flux, self.tr_ivar,
-                    q=q, delta_lambda=delta_lambda, ranges=self.ranges,
-                    n_proc=n_proc, verbose=verbose)
-
-
-    def continuum_normalize(self, cont):
+
+        shape = self.tr_flux.shape
+        norm_flux = self._new_array("tr_flux_norm", shape)
+        norm_ivar = self._new_array("tr_ivar_norm", shape)
+        # one pool of workers, if any, for all blocks
+        pool = ContinuumPool(n_proc) if n_proc > 1 else None
+        try:
+            for start, stop, flux, ivar in self.iter_chunks("tr", block_size):
+                if pool is None and self.ranges is None:
+                    norm = _cont_norm_running_quantile(
+                        self.wl, flux, ivar,
+                        q=q, delta_lambda=delta_lambda,
+                        verbose=verbose)
+                elif pool is None:
+                    norm = _cont_norm_running_quantile_regions(
+                        self.wl, flux, ivar,
+                        q=q, delta_lambda=delta_lambda,
+                        ranges=self.ranges, verbose=verbose)
+                elif self.ranges is None:
+                    norm = _cont_norm_running_quantile_mp(
+                        self.wl, flux, ivar,
+                        q=q, delta_lambda=delta_lambda,
+                        verbose=verbose, pool=pool)
+                else:
+                    norm = _cont_norm_running_quantile_regions_mp(
+                        self.wl, flux, ivar,
+                        q=q, delta_lambda=delta_lambda, ranges=self.ranges,
+                        verbose=verbose, pool=pool)
+                norm_flux[start:stop], norm_ivar[start:stop] = norm
+        finally:
+            if pool is not None:
+                pool.close()
+        return norm_flux, norm_ivar
+
+
+    def continuum_normalize(self, cont, block_size=1000):
         """ 
         Continuum normalize spectra, in chunks if spectrum has regions 
 
@@ -362,6 +564,8 @@ class Dataset(object):
         ----------
         cont: ndarray
            Flux values corresponding to the continuum 
+        block_size: int
+           Number of spectra normalized at once
 
         Returns
         -------
@@ -374,23 +578,30 @@ class Dataset(object):
         norm_test_ivar: numpy ndarray
             Rescaled inverse variance values for the test objects
         """
-        tr_cont, test_cont = cont
         if self.ranges is None:
             print("assuming continuous spectra")
-            norm_tr_flux, norm_tr_ivar = _cont_norm(
-                    self.tr_flux, self.tr_ivar, tr_cont)
-            norm_test_flux, norm_test_ivar = _cont_norm(
-                    self.test_flux, self.test_ivar, test_cont)
         else:
             print("taking spectra in %s regions" %(len(self.ranges)))
-            norm_tr_flux, norm_tr_ivar = _cont_norm_regions(
-                    self.tr_flux, self.tr_ivar, tr_cont, self.ranges)
-            norm_test_flux, norm_test_ivar = _cont_norm_regions(
-                    self.test_flux, self.test_ivar, test_cont, self.ranges)
+        output = []
+        for which, cont_all in zip(("tr", "test"), cont):
+            shape = getattr(self, which + "_flux").shape
+            norm_flux = self._new_array(which + "_flux_norm", shape)
+            norm_ivar = self._new_array(which + "_ivar_norm", shape)
+            for start, stop, flux, ivar in self.iter_chunks(which, block_size):
+                block_cont = np.asarray(cont_all[start:stop])
+                if self.ranges is None:
+                    norm = _cont_norm(flux, ivar, block_cont)
+                else:
+                    norm = _cont_norm_regions(
+                            flux, ivar, block_cont, self.ranges)
+                norm_flux[start:stop], norm_ivar[start:stop] = norm
+            output.extend([norm_flux, norm_ivar])
+        norm_tr_flux, norm_tr_ivar, norm_test_flux, norm_test_ivar = output
         return norm_tr_flux, norm_tr_ivar, norm_test_flux, norm_test_ivar
 
 
-    def continuum_normalize_gaussian_smoothing(self, L):
+    def continuum_normalize_gaussian_smoothing(self, L, backend="auto",
+                                               n_sigma=6., block_size=1000):
         """ Continuum normalize using a Gaussian-weighted smoothed spectrum
 
         Parameters
@@ -399,9 +610,19 @@ class Dataset(object):
             the dataset to continuum normalize
         L: float
             the width of the Gaussian used for weighting
+        backend: str
+            'convolve' (constant wavelength step), 'banded' (any sorted
+            grid), 'auto' to pick one of these, or 'dense' to use the full
+            npixels by npixels weight matrix without truncation
+        n_sigma: float
+            the Gaussian is cut at n_sigma*L, unless backend is 'dense'
+        block_size: int
+            number of spectra normalized at once
         """
         norm_tr_flux, norm_tr_ivar, norm_test_flux, norm_test_ivar = \
-                _cont_norm_gaussian_smooth(self, L)
+                _cont_norm_gaussian_smooth(self, L, backend=backend,
+                                           n_sigma=n_sigma,
+                                           block_size=block_size)
         self.tr_flux = norm_tr_flux
         self.tr_ivar = norm_tr_ivar
         self.test_flux = norm_test_flux
@@ -581,7 +802,7 @@ def convert_to_hdulist(ds):
     # construct HDU list
     assert len(data_list) == len(name_list)
     n_hdus = len(data_list)
-    for i in xrange(n_hdus):
+    for i in range(n_hdus):
         print('@Bo Zhang: transforming HDU [%d/%d]: %s ...'
               % (i+1, n_hdus, name_list[i]))
         if hdu_format_list_rw[i] == 'table':
@@ -34,9 +34,55 @@ def _find_contpix_given_cuts(f_cut, sig_cut, wl, fluxes, ivars):
     return contmask
 
 
+def _contpix_need(fluxes):
+    """ The smallest cut at which each pixel passes _find_contpix_given_cuts
+
+    With equal flux and sigma cuts c, a pixel is continuum when
+    max(abs(fbar-1), f_sig) <= c; pixels that can never pass get inf.
+
+    Parameters
+    ----------
+    fluxes: numpy ndarray of shape (nstars, npixels)
+        pixel intensities
+
+    Returns
+    -------
+    need: numpy ndarray of length npixels
+    """
+    f_bar = np.median(fluxes, axis=0)
+    sigma_f = np.var(fluxes, axis=0)
+    bad = np.logical_and(f_bar==0, sigma_f==0)
+    need = np.maximum(np.abs(f_bar-1), sigma_f)
+    need[bad | np.isnan(need)] = np.inf
+    return need
+
+
+def _first_cut_above(threshold, start, stepsize, block_size=100000):
+    """ First value of the sequence start, start+step, ... that is >= threshold
+
+    The sequence is accumulated in floating point one step at a time, like
+    the cut of the stepping loop it replaces, so that the value is the
+    same to the last bit.
+    """
+    cut = start
+    if cut >= threshold:
+        return cut
+    steps = np.full(block_size, stepsize)
+    while True:
+        cuts = np.add.accumulate(np.concatenate(([cut], steps)))[1:]
+        if cuts[-1] >= threshold:
+            return cuts[np.searchsorted(cuts, threshold, side='left')]
+        cut = cuts[-1]
+
+
 def _find_contpix(wl, fluxes, ivars, target_frac):
     """ Find continuum pix in spec, meeting a set target fraction
 
+    The flux and sigma cuts start at 0.0001 and are raised together in steps
+    of 0.0001 until the target fraction is reached. The pixel statistics are
+    computed once, and the cut where the fraction is first reached is found
+    from the sorted per-pixel cuts, rather than by stepping.
+
     Parameters
     ----------
     wl: numpy ndarray
@@ -61,22 +107,25 @@ def _find_contpix(wl, fluxes, ivars, target_frac):
     bad2 = np.var(ivars, axis=0) == 0
     bad = np.logical_and(bad1, bad2)
     npixels = len(wl)-sum(bad)
-    f_cut = 0.0001
     stepsize = 0.0001
-    sig_cut = 0.0001
-    contmask = _find_contpix_given_cuts(f_cut, sig_cut, wl, fluxes, ivars)
+    need = _contpix_need(fluxes)
+    sorted_need = np.sort(need)
+
+    # the fewest continuum pixels that reach the target fraction
     if npixels > 0:
-        frac = sum(contmask)/float(npixels)
+        counts = np.arange(len(need)+1)
+        reached = counts / float(npixels) >= target_frac
     else:
-        frac = 0
-    while (frac < target_frac): 
-        f_cut += stepsize
-        sig_cut += stepsize
-        contmask = _find_contpix_given_cuts(f_cut, sig_cut, wl, fluxes, ivars)
-        if npixels > 0:
-            frac = sum(contmask)/float(npixels)
-        else:
-            frac = 0
+        reached = np.zeros(len(need)+1, dtype=bool)
+    reached[1:] &= np.isfinite(sorted_need)
+    if not reached.any():
+        raise ValueError("no cut reaches a continuum fraction of %s"
+                         % target_frac)
+    ncont = np.argmax(reached)
+    threshold = sorted_need[ncont-1] if ncont > 0 else -np.inf
+    f_cut = sig_cut = _first_cut_above(threshold, 0.0001, stepsize)
+    contmask = need <= f_cut
+    frac = sum(contmask)/float(npixels) if npixels > 0 else 0
     if frac > 0.10*npixels:
         print("Warning: Over 10% of pixels identified as continuum.")
     print("%s out of %s pixels identified as continuum" %(sum(contmask), 
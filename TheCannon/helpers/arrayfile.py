@@ -0,0 +1,109 @@
+""" Named arrays and a JSON header in one file, mappable without copies
+
+The file starts with a magic string, the length of the header and the
+header itself, JSON text giving the format version, the metadata of the
+writer and the dtype, shape and offset of each array. The raw arrays follow
+in the order they were given, each starting on a 64-byte boundary, so that
+any of them can be memory-mapped in place and those that are not wanted
+are never read.
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import json
+import struct
+import numpy as np
+
+__all__ = ['write_array_file', 'read_array_file']
+
+_MAGIC = b"TheCannon arrays"
+_VERSION = 1
+_ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def write_array_file(path, arrays, meta=None):
+    """ Write arrays and metadata to one file
+
+    Parameters
+    ----------
+    path: str
+        the file; written to a temporary file that then replaces it
+    arrays: list of (str, numpy ndarray)
+        the arrays by name, in the order in which they are laid out; put
+        large arrays that are rarely read last
+    meta: dict, optional
+        metadata, any JSON-serializable values
+    """
+    layout = []
+    offset = 0
+    for name, arr in arrays:
+        arr = np.asarray(arr)
+        layout.append({'name': name, 'dtype': arr.dtype.str,
+                       'shape': list(arr.shape), 'offset': offset})
+        offset = _aligned(offset + arr.nbytes)
+    header = json.dumps({'version': _VERSION, 'meta': meta or {},
+                         'arrays': layout}).encode('utf-8')
+    start = _aligned(len(_MAGIC) + 8 + len(header))
+    header += b" " * (start - len(_MAGIC) - 8 - len(header))
+
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for (name, arr), entry in zip(arrays, layout):
+            f.seek(start + entry['offset'])
+            f.write(np.ascontiguousarray(arr).tobytes())
+        f.truncate(start + offset)
+    os.rename(tmp, path)
+
+
+def read_array_file(path, names=None, mmap=True):
+    """ Read arrays and metadata written by write_array_file
+
+    Parameters
+    ----------
+    path: str
+        the file
+    names: list of str, optional
+        the arrays to read; all of them if None
+    mmap: bool
+        map the arrays read-only instead of reading them into memory
+
+    Returns
+    -------
+    arrays: dict
+        the arrays read, by name
+    meta: dict
+        the metadata
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("%s is not a TheCannon array file" % path)
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size).decode('utf-8'))
+        if header['version'] > _VERSION:
+            raise ValueError("%s has format version %s, this version of "
+                             "TheCannon reads up to %s"
+                             % (path, header['version'], _VERSION))
+        start = len(_MAGIC) + 8 + size
+        arrays = {}
+        for entry in header['arrays']:
+            if names is not None and entry['name'] not in names:
+                continue
+            dtype = np.dtype(entry['dtype'])
+            shape = tuple(entry['shape'])
+            count = int(np.prod(shape))
+            if count == 0:
+                arr = np.zeros(shape, dtype=dtype)
+            elif mmap:
+                arr = np.memmap(path, dtype=dtype, mode='r', shape=shape,
+                                offset=start + entry['offset'])
+            else:
+                f.seek(start + entry['offset'])
+                arr = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+            arrays[entry['name']] = arr
+    return arrays, header['meta']
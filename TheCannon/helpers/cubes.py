@@ -0,0 +1,71 @@
+""" Flux and ivar cubes that may be too large to hold in memory
+
+A cube is any array of shape (nstars, npixels): an in-memory numpy array,
+an np.memmap, or the path of a .npy file, which is memory-mapped read-only.
+Operations on large cubes work through them in blocks of stars, and write
+their results to .npy files mapped in an output directory.
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import sys
+import numpy as np
+
+__all__ = ['load_cube', 'new_array', 'iter_blocks']
+
+if sys.version_info[0] > 2:
+    basestring = (str, bytes)
+else:
+    basestring = (str, unicode)
+
+
+def load_cube(cube):
+    """ Map a cube given as the path of a .npy file; return others as is
+
+    Parameters
+    ----------
+    cube: numpy ndarray, np.memmap or str
+        the cube, or the path of a .npy file holding it
+
+    Returns
+    -------
+    cube: numpy ndarray or np.memmap
+    """
+    if isinstance(cube, basestring):
+        return np.load(cube, mmap_mode='r')
+    return cube
+
+
+def new_array(shape, out_dir=None, name=None, dtype=float):
+    """ A zero-filled output array, in memory or mapped from a .npy file
+
+    Parameters
+    ----------
+    shape: tuple
+        shape of the array
+    out_dir: str, optional
+        directory of the .npy file; the array is kept in memory if None
+    name: str
+        name of the .npy file, without extension; a number is appended
+        if the file exists, so that an input cube is never overwritten
+    dtype: numpy dtype
+        data type of the array
+
+    Returns
+    -------
+    array: numpy ndarray or np.memmap
+    """
+    if out_dir is None:
+        return np.zeros(shape, dtype=dtype)
+    path = os.path.join(out_dir, "%s.npy" % name)
+    count = 0
+    while os.path.exists(path):
+        count += 1
+        path = os.path.join(out_dir, "%s_%d.npy" % (name, count))
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                     shape=tuple(shape))
+
+
+def iter_blocks(nrows, block_size=1000):
+    """ Start and stop of consecutive blocks of at most block_size rows """
+    for start in range(0, nrows, block_size):
+        yield start, min(start + block_size, nrows)
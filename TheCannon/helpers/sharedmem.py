@@ -0,0 +1,136 @@
+""" Arrays that worker processes can map instead of receiving pickled copies
+
+Each array is backed by a memory-mapped temporary file, placed in /dev/shm
+where available so that it stays in RAM. Workers attach to it from a small
+picklable spec (filename, shape, dtype), so the data is never copied
+per task.
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+import numpy as np
+
+__all__ = ['SharedArray', 'blas_thread_env', 'limit_blas_threads',
+           'blas_threads_per_proc']
+
+# read by the common BLAS and OpenMP runtimes when they start
+_BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                  'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                  'NUMEXPR_NUM_THREADS')
+
+
+def _shared_dir():
+    """ Directory for the backing files: RAM-backed if the system has one """
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return None
+
+
+class SharedArray(object):
+    """ A numpy array in a memory-mapped file, shareable between processes
+
+    Parameters
+    ----------
+    shape: tuple
+        shape of the array
+    dtype: numpy dtype
+        data type of the array
+    filename: str, optional
+        backing file of an existing shared array to attach to; if None,
+        a new zero-filled array is created and owned by this object
+    """
+    def __init__(self, shape, dtype=float, filename=None):
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self._owner = filename is None
+        if self._owner:
+            fd, filename = tempfile.mkstemp(
+                    prefix='thecannon_', suffix='.dat', dir=_shared_dir())
+            os.close(fd)
+            mode = 'w+'
+        else:
+            mode = 'r+'
+        self.filename = filename
+        if int(np.prod(self.shape)) == 0:
+            self.array = np.zeros(self.shape, dtype=self.dtype)
+        else:
+            self.array = np.memmap(
+                    filename, dtype=self.dtype, mode=mode, shape=self.shape)
+
+    @classmethod
+    def copy_of(cls, arr):
+        """ Create a shared array holding a C-contiguous copy of arr """
+        arr = np.asarray(arr)
+        shared = cls(arr.shape, arr.dtype)
+        shared.array[...] = arr
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        """ Map an existing shared array from its spec """
+        filename, shape, dtype = spec
+        return cls(shape, dtype, filename=filename)
+
+    @property
+    def spec(self):
+        """ Picklable description used by other processes to attach """
+        return (self.filename, self.shape, self.dtype.str)
+
+    def release(self):
+        """ Unmap the array, and remove the backing file if we own it """
+        self.array = None
+        if self._owner and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def blas_threads_per_proc(n_proc):
+    """ BLAS threads per worker so that n_proc workers fill the machine """
+    return max(1, cpu_count() // max(1, n_proc))
+
+
+@contextmanager
+def blas_thread_env(n_threads):
+    """ Set the BLAS thread variables for processes started in this block
+
+    Worker processes that are spawned rather than forked load their BLAS
+    library afresh, and pick up these limits when they do.
+    """
+    saved = dict((var, os.environ.get(var)) for var in _BLAS_ENV_VARS)
+    for var in _BLAS_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    try:
+        yield
+    finally:
+        for var, val in saved.items():
+            if val is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = val
+
+
+def limit_blas_threads(n_threads):
+    """ Limit the BLAS threads of the current process, e.g. a pool worker
+
+    Uses threadpoolctl if it is installed, which also works on a BLAS
+    library that is already loaded (as in forked workers); otherwise the
+    limits rely on the environment set by blas_thread_env.
+
+    Returns
+    -------
+    the threadpoolctl limiter, or None
+    """
+    for var in _BLAS_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    return threadpool_limits(limits=n_threads, user_api='blas')
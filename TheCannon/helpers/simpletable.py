@@ -35,7 +35,7 @@ package.
 from __future__ import (absolute_import, division, print_function)
 
 __version__ = '3.0'
-__all__ = ['AstroHelpers', 'AstroTable', 'SimpleTable', 'stats']
+__all__ = ['AstroHelpers', 'AstroTable', 'SimpleTable', 'SkyIndex', 'stats']
 
 import sys
 import math
@@ -59,6 +59,11 @@ try:
 except ImportError:
     tables = None
 
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
 # ==============================================================================
 # Python 3 compatibility behavior
 # ==============================================================================
@@ -1223,6 +1228,28 @@ class AstroHelpers(object):
         ao = ( (a + psi[i] + fourpi) % twopi) * R2D
         return ao, bo
 
+    @staticmethod
+    def radec2xyz(ra, dec):
+        """ Convert sky coordinates into unit vectors
+
+        Parameters
+        ----------
+        ra: float or sequence
+            right ascensions in degrees
+
+        dec: float or sequence
+            declinations in degrees
+
+        Returns
+        -------
+        xyz: ndarray[ndim=2, dtype=float]
+            one unit vector (x, y, z) per position
+        """
+        ra_r = deg2rad(np.atleast_1d(np.asarray(ra, dtype=float)))
+        dec_r = deg2rad(np.atleast_1d(np.asarray(dec, dtype=float)))
+        cd = cos(dec_r)
+        return np.column_stack((cd * cos(ra_r), cd * sin(ra_r), sin(dec_r)))
+
     @staticmethod
     def sphdist(ra1, dec1, ra2, dec2):
         """measures the spherical distance between 2 points
@@ -1288,12 +1315,9 @@ class AstroHelpers(object):
             elif outtype is 2:
                 return conditional vector and distance to all ra0, dec0
         """
-        @elementwise
-        def getDist( pk ):
-            """ get spherical distance between 2 points """
-            return AstroHelpers.sphdist(pk[0], pk[1], ra, dec)
-
-        dist = np.array(list(getDist(zip(ra0, dec0))))
+        dist = np.asarray(AstroHelpers.sphdist(np.asarray(ra0, dtype=float),
+                                               np.asarray(dec0, dtype=float),
+                                               ra, dec))
         v = (dist <= r)
 
         if outtype == 0:
@@ -1304,6 +1328,148 @@ class AstroHelpers(object):
             return v, dist
 
 
+class SkyIndex(object):
+    """ Spatial index of sky positions for batched cone searches and
+    nearest-neighbour cross-matches
+
+    Positions are kept as unit vectors in a KD-tree, in which an angle r
+    is the chord 2 sin(r / 2). The candidates found in the tree are checked
+    with :func:`AstroHelpers.sphdist`, so that a cone search returns exactly
+    the rows :func:`AstroHelpers.conesearch` does.
+
+    .. code-block::python
+
+        >>> idx = SkyIndex(apogee_ra, apogee_dec)
+        # nearest APOGEE star of each LAMOST star, within 3 arcsec
+        >>> rows, sep = idx.nearest(lamost_ra, lamost_dec, r=3. / 3600.)
+        # all APOGEE stars within 1 arcmin of each LAMOST star
+        >>> icone, rows, sep = idx.cone(lamost_ra, lamost_dec, 1. / 60.)
+
+    Parameters
+    ----------
+    ra: ndarray[ndim=1, dtype=float]
+        right ascensions in degrees
+
+    dec: ndarray[ndim=1, dtype=float]
+        declinations in degrees
+
+    leafsize: int
+        number of points at which the tree stops splitting
+    """
+    def __init__(self, ra, dec, leafsize=16):
+        if cKDTree is None:
+            raise RuntimeError('scipy is required to build a SkyIndex')
+        self.ra = np.atleast_1d(np.asarray(ra, dtype=float)).ravel()
+        self.dec = np.atleast_1d(np.asarray(dec, dtype=float)).ravel()
+        if len(self.ra) != len(self.dec):
+            raise ValueError('ra and dec must have the same length')
+        self.tree = cKDTree(AstroHelpers.radec2xyz(self.ra, self.dec),
+                            leafsize=leafsize)
+
+    def __len__(self):
+        return len(self.ra)
+
+    @staticmethod
+    def _chord(r):
+        """ Chord of the angle r in degrees, widened against rounding """
+        r = np.clip(np.asarray(r, dtype=float), 0., 180.)
+        return 2. * sin(deg2rad(r) / 2.) * (1. + 1e-8) + 1e-12
+
+    def cone(self, ra, dec, r):
+        """ Cone searches around many positions at once
+
+        Parameters
+        ----------
+        ra: float or sequence
+            right ascensions of the cone centers in degrees
+
+        dec: float or sequence
+            declinations of the cone centers in degrees
+
+        r: float or sequence
+            radius of every cone, or of each cone, in degrees
+
+        Returns
+        -------
+        icone: ndarray[ndim=1, dtype=int]
+            the cone of each match
+
+        idx: ndarray[ndim=1, dtype=int]
+            the indexed position of each match
+
+        dist: ndarray[ndim=1, dtype=float]
+            the distance of each match in degrees
+
+        matches are sorted by cone, then by index
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=float)).ravel()
+        dec = np.atleast_1d(np.asarray(dec, dtype=float)).ravel()
+        r = np.broadcast_to(np.asarray(r, dtype=float), ra.shape)
+        if (len(ra) == 0) or (len(self) == 0):
+            empty = np.zeros(0, dtype=int)
+            return empty, empty, np.zeros(0, dtype=float)
+        xyz = AstroHelpers.radec2xyz(ra, dec)
+        if np.all(r == r[0]):
+            pairs = cKDTree(xyz).sparse_distance_matrix(
+                self.tree, self._chord(r[0]), output_type='ndarray')
+            icone = pairs['i'].astype(int)
+            idx = pairs['j'].astype(int)
+        else:
+            found = self.tree.query_ball_point(xyz, self._chord(r))
+            counts = np.array([len(k) for k in found], dtype=int)
+            icone = np.repeat(np.arange(len(found)), counts)
+            idx = np.fromiter(itertools.chain.from_iterable(found),
+                              dtype=int, count=counts.sum())
+        dist = np.asarray(AstroHelpers.sphdist(self.ra[idx], self.dec[idx],
+                                               ra[icone], dec[icone]))
+        keep = dist <= r[icone]
+        icone, idx, dist = icone[keep], idx[keep], dist[keep]
+        order = np.lexsort((idx, icone))
+        return icone[order], idx[order], dist[order]
+
+    def nearest(self, ra, dec, r=None):
+        """ Nearest indexed position of each given position
+
+        Parameters
+        ----------
+        ra: float or sequence
+            right ascensions in degrees
+
+        dec: float or sequence
+            declinations in degrees
+
+        r: float, optional
+            largest distance of a match in degrees
+
+        Returns
+        -------
+        idx: ndarray[ndim=1, dtype=int]
+            the nearest indexed position, -1 where there is none within r
+
+        dist: ndarray[ndim=1, dtype=float]
+            its distance in degrees, inf where there is none within r
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=float)).ravel()
+        dec = np.atleast_1d(np.asarray(dec, dtype=float)).ravel()
+        if r is None:
+            bound = np.inf
+        else:
+            bound = self._chord(r)
+        _, idx = self.tree.query(AstroHelpers.radec2xyz(ra, dec), k=1,
+                                 distance_upper_bound=bound)
+        idx = np.asarray(idx, dtype=int)
+        found = idx < len(self)
+        dist = np.full(len(ra), np.inf)
+        dist[found] = AstroHelpers.sphdist(self.ra[idx[found]],
+                                           self.dec[idx[found]],
+                                           ra[found], dec[found])
+        if r is not None:
+            found &= (dist <= r)
+        idx[~found] = -1
+        dist[~found] = np.inf
+        return idx, dist
+
+
 # ==============================================================================
 # SimpleTable -- provides table manipulations with limited storage formats
 # ==============================================================================
@@ -2499,6 +2665,55 @@ class AstroTable(SimpleTable):
         dec0 = self.get_DEC()
         return AstroHelpers.conesearch(ra0, dec0, ra, dec, r, outtype=outtype)
 
+    def sky_index(self, leafsize=16):
+        """ Spatial index of the table coordinates, see :class:`SkyIndex`
+
+        Build it once to run many cone searches or matches against the
+        table.
+        """
+        if (self._ra_name is None) or (self._dec_name is None):
+            raise AttributeError('Coordinate columns not set.')
+        return SkyIndex(self.get_RA(), self.get_DEC(), leafsize=leafsize)
+
+    def crossmatch(self, other, r, nearest=True):
+        """ Match the rows of this table to the rows of another by position
+
+        Parameters
+        ----------
+        other: AstroTable or SkyIndex
+            table to match against, or the index of its coordinates
+
+        r: float
+            largest distance of a match in degrees
+
+        nearest: bool
+            if set, only the nearest row of other within r is kept for each
+            row; otherwise every pair of rows within r is returned
+
+        Returns
+        -------
+        idx: ndarray[ndim=1, dtype=int]
+            indices of the matched rows of this table
+
+        idx_other: ndarray[ndim=1, dtype=int]
+            indices of the matching rows of other
+
+        dist: ndarray[ndim=1, dtype=float]
+            separations in degrees
+        """
+        if (self._ra_name is None) or (self._dec_name is None):
+            raise AttributeError('Coordinate columns not set.')
+        if not isinstance(other, SkyIndex):
+            other = other.sky_index()
+        ra = self.get_RA()
+        dec = self.get_DEC()
+        if nearest:
+            idx_other, dist = other.nearest(ra, dec, r=r)
+            idx = np.where(idx_other >= 0)[0]
+            return idx, idx_other[idx], dist[idx]
+        else:
+            return other.cone(ra, dec, r)
+
     def zoneSearch(self, ramin, ramax, decmin, decmax, outtype=0):
         """ Perform a zone search on a table, i.e., a rectangular selection
         Parameters
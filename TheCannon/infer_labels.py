@@ -2,8 +2,12 @@ from __future__ import (absolute_import, division, print_function, unicode_liter
 
 from scipy import optimize as opt
 import numpy as np
+import multiprocessing as mp
 import matplotlib.pyplot as plt
 from TheCannon import train_model
+from .helpers.sharedmem import (SharedArray, blas_thread_env,
+                                limit_blas_threads, blas_threads_per_proc)
+from .helpers.cubes import new_array, iter_blocks
 
 def _get_lvec(labels):
     """
@@ -21,12 +25,9 @@ def _get_lvec(labels):
         label vector
     """
     nlabels = len(labels)
-    # specialized to second-order model
-    linear_terms = labels 
-    quadratic_terms = np.outer(linear_terms, 
-                               linear_terms)[np.triu_indices(nlabels)]
-    lvec = np.hstack((linear_terms, quadratic_terms))
-    return lvec
+    # drop the constant term, which is the pivot of the fit
+    lvec = train_model._get_lvec(np.array(labels), np.zeros(nlabels))
+    return lvec[0, 1:]
 
 
 def _func(coeffs, *labels):
@@ -48,46 +49,269 @@ def _func(coeffs, *labels):
     return np.dot(coeffs, lvec)
 
 
-def _infer_labels(model, dataset, starting_guess=None):
+def _jac(coeffs, *labels):
+    """ Exact Jacobian of _func with respect to the labels
+
+    Parameters
+    ----------
+    coeffs: numpy ndarray
+        the coefficients on each element of the label vector
+
+    *labels: numpy ndarray
+        label vector
+
+    Returns
+    -------
+    jac: numpy ndarray, shape (npix, nlabels)
+        derivative of the model at each pixel with respect to each label
     """
-    Uses the model to solve for labels of the test set.
+    nlabels = len(labels)
+    lvec, lvec_derivs = train_model._get_lvec(
+            np.array(labels), np.zeros(nlabels), derivs=True)
+    return np.dot(coeffs, lvec_derivs[0, 1:, :])
+
+
+def _model_and_jac(coeffs, labels):
+    """ Model spectra and their Jacobians for a block of stars
 
     Parameters
     ----------
-    model: tuple
-        Coeffs_all, covs, scatters, chis, chisqs, pivots
+    coeffs: numpy ndarray, shape (npix, nterms-1)
+        coefficients without the leading (pivot) term
 
-    dataset: Dataset
-        Dataset that needs label inference
+    labels: numpy ndarray, shape (nstars, nlabels)
+        pivoted and scaled labels
 
     Returns
     -------
-    errs_all:
-        Covariance matrix of the fit
+    model: numpy ndarray, shape (nstars, npix)
+        pivoted model spectra
+
+    jac: numpy ndarray, shape (nstars, nlabels, npix)
+        derivatives of the model spectra with respect to the labels
+    """
+    nstars, nlabels = labels.shape
+    lvec, lvec_derivs = train_model._get_lvec(
+            labels, np.zeros(nlabels), derivs=True)
+    model = np.dot(lvec[:, 1:], coeffs.T)
+    # one matrix product for all stars and labels
+    lvec_derivs = np.swapaxes(lvec_derivs[:, 1:, :], 1, 2)
+    jac = np.dot(lvec_derivs.reshape(nstars*nlabels, -1), coeffs.T)
+    return model, jac.reshape(nstars, nlabels, -1)
+
+
+def _normal_equations(coeffs, labels, fluxes, weights):
+    """ Weighted normal equations of the label fit for a block of stars
+
+    Returns
+    -------
+    JTWJ: numpy ndarray, shape (nstars, nlabels, nlabels)
+    JTWr: numpy ndarray, shape (nstars, nlabels)
+    chisq: numpy ndarray, shape (nstars, )
+    """
+    model, jac = _model_and_jac(coeffs, labels)
+    resid = fluxes - model
+    wJ = weights[:, None, :] * jac
+    JTWJ = np.matmul(wJ, np.swapaxes(jac, 1, 2))
+    JTWr = np.matmul(wJ, resid[..., None])[..., 0]
+    chisq = np.sum(weights * resid**2, axis=1)
+    return JTWJ, JTWr, chisq
+
+
+def _invert_stacked(mats):
+    """ Invert a stack of matrices, with inf for the singular ones """
+    try:
+        return np.linalg.inv(mats)
+    except np.linalg.LinAlgError:
+        out = np.zeros(mats.shape) + np.inf
+        for ii, mat in enumerate(mats):
+            try:
+                out[ii] = np.linalg.inv(mat)
+            except np.linalg.LinAlgError:
+                pass
+        return out
+
+
+def _fit_labels_lm(coeffs, fluxes, weights, p0, max_iter=200,
+                   ftol=1.49012e-08, xtol=1.49012e-08):
+    """
+    Levenberg-Marquardt fit of the labels of a block of stars at once
+
+    Every star has its own damping parameter and stops on its own once
+    converged; the normal equations of all of the active stars are
+    formed and solved as one stack.
+
+    Parameters
+    ----------
+    coeffs: numpy ndarray, shape (npix, nterms-1)
+        coefficients without the leading (pivot) term
+
+    fluxes: numpy ndarray, shape (nstars, npix)
+        pivoted fluxes
+
+    weights: numpy ndarray, shape (nstars, npix)
+        inverse variances of the fit, 1 / (sigma^2 + scatter^2)
+
+    p0: numpy ndarray, shape (nstars, nlabels)
+        starting guesses
+
+    max_iter: int
+        maximum number of iterations for each star
+
+    ftol: float
+        relative tolerance on the reduction of chi^2
+
+    xtol: float
+        relative tolerance on the label step
+
+    Returns
+    -------
+    labels: numpy ndarray, shape (nstars, nlabels)
+        best-fit labels
+
+    covs: numpy ndarray, shape (nstars, nlabels, nlabels)
+        covariance matrices of the labels
+
+    converged: numpy ndarray of bool, shape (nstars, )
+        False for stars that reached max_iter
+    """
+    nstars, nlabels = p0.shape
+    labels = np.array(p0, dtype=float)
+    JTWJ, JTWr, chisq = _normal_equations(coeffs, labels, fluxes, weights)
+    damping = 1e-3 * np.ones(nstars)
+    niter = np.zeros(nstars, dtype=int)
+    converged = np.zeros(nstars, dtype=bool)
+    diag = np.arange(nlabels)
+
+    active = np.arange(nstars)
+    while len(active) > 0:
+        A = JTWJ[active]
+        scale = np.maximum(A[:, diag, diag], 1e-30)
+        A[:, diag, diag] += damping[active][:, None] * scale
+        try:
+            step = np.linalg.solve(A, JTWr[active][..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('skl,sl->sk', _invert_stacked(A), JTWr[active])
+            step[~np.isfinite(step)] = 0.
+        trial = labels[active] + step
+        trial_JTWJ, trial_JTWr, trial_chisq = _normal_equations(
+                coeffs, trial, fluxes[active], weights[active])
+
+        accept = trial_chisq <= chisq[active]
+        acc = active[accept]
+        reduction = chisq[acc] - trial_chisq[accept]
+        small_f = reduction <= ftol * chisq[acc]
+        small_x = np.sqrt(np.sum(step[accept]**2, axis=1)) <= \
+                  xtol * (np.sqrt(np.sum(labels[acc]**2, axis=1)) + xtol)
+        labels[acc] = trial[accept]
+        JTWJ[acc] = trial_JTWJ[accept]
+        JTWr[acc] = trial_JTWr[accept]
+        chisq[acc] = trial_chisq[accept]
+        damping[acc] /= 10.
+        damping[active[~accept]] *= 10.
+        niter[active] += 1
+
+        done = np.zeros(len(active), dtype=bool)
+        done[accept] = small_f | small_x
+        # no step improves the fit anymore
+        done[~accept] = damping[active[~accept]] > 1e16
+        converged[active[done]] = True
+        done |= niter[active] >= max_iter
+        active = active[~done]
+
+    covs = _invert_stacked(JTWJ)
+    return labels, covs, converged
+
+
+def _infer_labels_batched(model, fluxes, ivars, guesses, rows=None,
+                          block_size=1000):
+    """
+    Batched counterpart of _infer_labels_star: fits blocks of stars at once
+
+    Parameters
+    ----------
+    model: CannonModel
+        the trained model
+
+    fluxes, ivars: numpy ndarray, shape (nstars, npix)
+        test spectra
+
+    guesses: numpy ndarray, shape (nfits, nlabels)
+        pivoted and scaled starting labels, one per fit
+
+    rows: numpy ndarray of int, shape (nfits, ), optional
+        the star fit with each guess; one fit per star if None
+
+    block_size: int
+        number of fits done at once
+
+    Returns
+    -------
+    labels_all, errs_all, chisq_all: as in _infer_labels, one per fit,
+    with the labels still pivoted and scaled
     """
-    print("Inferring Labels")
     coeffs_all = model.coeffs
     scatters = model.scatters
-    #chisqs = model.chisqs
-    nlabels = len(dataset.get_plotting_labels())
-    fluxes = dataset.test_flux
-    ivars = dataset.test_ivar
-    nstars = fluxes.shape[0]
-    labels_all = np.zeros((nstars, nlabels))
-    MCM_rotate_all = np.zeros((nstars, coeffs_all.shape[1] - 1,
-                               coeffs_all.shape[1]-1.))
-    errs_all = np.zeros((nstars, nlabels))
-    chisq_all = np.zeros(nstars)
-    scales = model.scales
-
-    if starting_guess == None:
-        starting_guess = np.ones(nlabels)
-
-    # print("starting guess: %s" %starting_guess)
-    for jj in range(nstars):
-        flux = fluxes[jj,:]
-        ivar = ivars[jj,:]
-        
+    coeffs = np.delete(coeffs_all, 0, axis=1)  # take pivot into account
+    nfits, nlabels = guesses.shape
+    labels_all = np.zeros((nfits, nlabels))
+    errs_all = np.zeros((nfits, nlabels))
+    chisq_all = np.zeros(nfits)
+    nfailed = 0
+    for start in range(0, nfits, block_size):
+        stop = min(start + block_size, nfits)
+        if rows is None:
+            flux = np.array(fluxes[start:stop], dtype=float)
+            ivar = np.array(ivars[start:stop], dtype=float)
+        else:
+            flux = np.array(fluxes[rows[start:stop]], dtype=float)
+            ivar = np.array(ivars[rows[start:stop]], dtype=float)
+
+        # where the ivar == 0, set the normalized flux to 1 and the sigma to 100
+        bad = ivar == 0
+        flux[bad] = 1.0
+        sigma2 = np.ones(ivar.shape) * 100.0**2
+        sigma2[~bad] = 1.0 / ivar[~bad]
+
+        flux_piv = flux - coeffs_all[:,0] * 1.  # pivot around the leading term
+        weights = 1. / (sigma2 + scatters**2)
+        labels, covs, converged = _fit_labels_lm(
+                coeffs, flux_piv, weights, guesses[start:stop])
+        if not np.all(converged):
+            nfailed += np.sum(~converged)
+            labels[~converged] = -9999.
+            covs[~converged] = -9999.
+        model_flux = np.dot(
+                train_model._get_lvec(labels, np.zeros(nlabels))[:, 1:],
+                coeffs.T)
+        chi2 = (flux_piv - model_flux)**2 * ivar / (1 + ivar * scatters**2)
+        chisq_all[start:stop] = np.sum(chi2, axis=1)
+        labels_all[start:stop] = labels
+        errs_all[start:stop] = np.diagonal(covs, axis1=1, axis2=2)
+    if nfailed > 0:
+        print("Error - fit failed to converge for %s stars" % nfailed)
+    return labels_all, errs_all, chisq_all
+
+
+def _infer_labels_star(model, fluxes, ivars, guesses, rows=None):
+    """
+    Fits one star at a time with scipy's curve_fit
+
+    Parameters and returns are the same as for _infer_labels_batched
+    """
+    coeffs_all = model.coeffs
+    scatters = model.scatters
+    nfits, nlabels = guesses.shape
+    labels_all = np.zeros((nfits, nlabels))
+    errs_all = np.zeros((nfits, nlabels))
+    chisq_all = np.zeros(nfits)
+    if rows is None:
+        rows = np.arange(nfits)
+
+    for jj, row in enumerate(rows):
+        flux = np.array(fluxes[row,:], dtype=float)
+        ivar = np.array(ivars[row,:], dtype=float)
+        p0 = guesses[jj]
 
         # where the ivar == 0, set the normalized flux to 1 and the sigma to 100
         bad = ivar == 0
@@ -101,22 +325,434 @@ def _infer_labels(model, dataset, starting_guess=None):
         
         try:
             labels, covs = opt.curve_fit(_func, coeffs, flux_piv,
-                                         p0 = starting_guess,
+                                         p0 = p0, jac=_jac,
                                          sigma=errbar, absolute_sigma=True)
         except RuntimeError:
             print("Error - curve_fit failed")
-            labels = np.zeros(starting_guess.shape)-9999.
-            covs = np.zeros((len(starting_guess),len(starting_guess)))-9999.
+            labels = np.zeros(p0.shape)-9999.
+            covs = np.zeros((len(p0),len(p0)))-9999.
         chi2 = (flux_piv-_func(coeffs, *labels))**2 * ivar / (1 + ivar * scatters**2)
         chisq_all[jj] = sum(chi2)
-        labels_all[jj,:] = model.scales * labels + model.pivots
+        labels_all[jj,:] = labels
         errs_all[jj,:] = covs.diagonal()
+    return labels_all, errs_all, chisq_all
+
+
+def _linear_starting_guess(model, fluxes, ivars, block_size=1000,
+                           max_offset=5.):
+    """
+    Closed-form starting labels from the model, linear in the label vector
+
+    Ignoring that the quadratic terms are products of the linear ones, the
+    model is linear in the label vector, so one weighted least-squares
+    solve per star gives the whole label vector; its linear block is the
+    guess. The normal equations of all stars in a block are formed with a
+    single matrix product and solved as one stack.
+
+    Parameters
+    ----------
+    model: CannonModel
+        the trained model
+
+    fluxes, ivars: numpy ndarray, shape (nstars, npix)
+        test spectra
+
+    block_size: int
+        number of stars solved at once
+
+    max_offset: float
+        guesses are clipped to this many scales from the pivots
+
+    Returns
+    -------
+    guesses: numpy ndarray, shape (nstars, nlabels)
+        pivoted and scaled starting labels
+    """
+    coeffs_all = model.coeffs
+    scatters = model.scatters
+    nlabels = len(model.pivots)
+    coeffs = np.delete(coeffs_all, 0, axis=1)  # take pivot into account
+    nterms = coeffs.shape[1]
+    coeffs_outer = (coeffs[:, :, None] * coeffs[:, None, :]).reshape(
+            len(coeffs), -1)
+    nstars = fluxes.shape[0]
+    guesses = np.zeros((nstars, nlabels))
+    for start in range(0, nstars, block_size):
+        stop = min(start + block_size, nstars)
+        flux = np.array(fluxes[start:stop], dtype=float)
+        ivar = np.array(ivars[start:stop], dtype=float)
+
+        # same weights as the fit: sigma = 100 where the ivar == 0
+        bad = ivar == 0
+        flux[bad] = 1.0
+        sigma2 = np.ones(ivar.shape) * 100.0**2
+        sigma2[~bad] = 1.0 / ivar[~bad]
+        weights = 1. / (sigma2 + scatters**2)
+
+        flux_piv = flux - coeffs_all[:,0] * 1.
+        ATA = np.dot(weights, coeffs_outer).reshape(-1, nterms, nterms)
+        ATb = np.dot(weights * flux_piv, coeffs)
+        try:
+            lvec = np.linalg.solve(ATA, ATb[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            lvec = np.array([np.linalg.lstsq(a, b, rcond=None)[0]
+                             for a, b in zip(ATA, ATb)])
+        guesses[start:stop] = lvec[:, :nlabels]
+    bad = ~np.isfinite(guesses)
+    guesses[bad] = 1.
+    return np.clip(guesses, -max_offset, max_offset)
+
+
+class _ModelArrays(object):
+    """ The parts of a CannonModel needed to fit labels, in a worker """
+    def __init__(self, coeffs, scatters):
+        self.coeffs = coeffs
+        self.scatters = scatters
+
+
+# shared arrays mapped by each inference worker, see _init_infer_worker
+_shared = {}
+
+
+def _init_infer_worker(specs, blas_threads):
+    """ Map the shared model, spectra and outputs in a worker process """
+    limit_blas_threads(blas_threads)
+    for key, spec in specs.items():
+        _shared[key] = SharedArray.attach(spec).array
+
+
+def _infer_chunk(task):
+    """ Fit one chunk of fits and write the results to the outputs """
+    start, stop, nrows, backend = task
+    model = _ModelArrays(_shared['coeffs'], _shared['scatters'])
+    fit = _infer_labels_batched if backend == "batched" else \
+          _infer_labels_star
+    # views into the shared spectra, no copies
+    output = fit(model, _shared['fluxes'][:nrows], _shared['ivars'][:nrows],
+                 _shared['guesses'][start:stop], _shared['rows'][start:stop])
+    _shared['labels'][start:stop] = output[0]
+    _shared['errs'][start:stop] = output[1]
+    _shared['chisq'][start:stop] = output[2]
+    return start, stop
+
+
+class _InferencePool(object):
+    """
+    Worker processes fitting labels, reused for every block and start
+
+    The model coefficients and scatters are placed in shared arrays once.
+    The spectra of a block, the guesses and the outputs go to shared
+    buffers of fixed size that the workers map when they start, so that
+    a whole inference run starts the processes once, and copies each
+    block of spectra once however many starts it is fit from. The BLAS
+    threads of the workers are limited so that the pool does not
+    oversubscribe the machine.
+
+    Parameters
+    ----------
+    model: CannonModel
+        the trained model
+    block_rows: int
+        the most spectra fit at once, e.g. the block size of _infer_labels
+    max_fits: int
+        the most fits sent to the workers at once; larger calls are split
+    backend: str
+        "batched" or "star", see _infer_labels
+    n_proc: int
+        number of worker processes
+    chunk_size: int
+        number of fits in one task
+    """
+    def __init__(self, model, block_rows, max_fits, backend="batched",
+                 n_proc=2, chunk_size=1000):
+        npix, nlabels = len(model.scatters), len(model.pivots)
+        self.block_rows = block_rows
+        self.max_fits = max_fits
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self._loaded = None
+        shapes = [('fluxes', (block_rows, npix), float),
+                  ('ivars', (block_rows, npix), float),
+                  ('guesses', (max_fits, nlabels), float),
+                  ('rows', (max_fits, ), int),
+                  ('labels', (max_fits, nlabels), float),
+                  ('errs', (max_fits, nlabels), float),
+                  ('chisq', (max_fits, ), float)]
+        blas_threads = blas_threads_per_proc(n_proc)
+        # arrays made so far are released if a later one or the pool fails
+        self._shared = {}
+        try:
+            self._shared['coeffs'] = SharedArray.copy_of(model.coeffs)
+            self._shared['scatters'] = SharedArray.copy_of(model.scatters)
+            for key, shape, dtype in shapes:
+                self._shared[key] = SharedArray(shape, dtype=dtype)
+            specs = dict((key, val.spec) for key, val in self._shared.items())
+            with blas_thread_env(blas_threads):
+                self._pool = mp.Pool(
+                        processes=n_proc, initializer=_init_infer_worker,
+                        initargs=(specs, blas_threads))
+        except Exception:
+            self._release()
+            raise
+
+    def fit(self, model, fluxes, ivars, guesses, rows=None):
+        """
+        Fits in the workers, with the parameters and returns of
+        _infer_labels_batched
+
+        The spectra are copied to the workers only when they are not the
+        ones of the previous call, e.g. once per block of a multi-start
+        fit.
+        """
+        shared = self._shared
+        if fluxes is not self._loaded:
+            nrows = len(fluxes)
+            if nrows > self.block_rows:
+                raise ValueError("%s spectra do not fit the pool's buffers "
+                                 "of %s" % (nrows, self.block_rows))
+            shared['fluxes'].array[:nrows] = fluxes
+            shared['ivars'].array[:nrows] = ivars
+            self._loaded = fluxes
+        nrows = len(fluxes)
+        nfits, nlabels = guesses.shape
+        if rows is None:
+            rows = np.arange(nfits)
+        labels_all = np.zeros((nfits, nlabels))
+        errs_all = np.zeros((nfits, nlabels))
+        chisq_all = np.zeros(nfits)
+        for first, last in iter_blocks(nfits, self.max_fits):
+            nbatch = last - first
+            shared['guesses'].array[:nbatch] = guesses[first:last]
+            shared['rows'].array[:nbatch] = rows[first:last]
+            tasks = [(start, stop, nrows, self.backend)
+                     for start, stop in iter_blocks(nbatch, self.chunk_size)]
+            for start, stop in self._pool.imap_unordered(_infer_chunk, tasks):
+                pass
+            labels_all[first:last] = shared['labels'].array[:nbatch]
+            errs_all[first:last] = shared['errs'].array[:nbatch]
+            chisq_all[first:last] = shared['chisq'].array[:nbatch]
+        return labels_all, errs_all, chisq_all
+
+    def _release(self):
+        for val in self._shared.values():
+            val.release()
+
+    def close(self):
+        """ Stop the worker processes and free the shared arrays """
+        self._pool.close()
+        self._pool.join()
+        self._loaded = None
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _infer_labels_parallel(model, fluxes, ivars, guesses, rows=None,
+                           backend="batched", n_proc=2, chunk_size=1000):
+    """
+    Fits chunks of stars in a pool of worker processes, started for this
+    call; _infer_labels keeps one _InferencePool for a whole run instead
+
+    Parameters and returns are the same as for _infer_labels_batched
+    """
+    with _InferencePool(model, len(fluxes), max(len(guesses), 1),
+                        backend=backend, n_proc=n_proc,
+                        chunk_size=chunk_size) as pool:
+        return pool.fit(model, fluxes, ivars, guesses, rows)
+
+
+def _get_starting_guesses(model, dataset, starting_guess, n_starts, seed):
+    """ Starting labels for each start of a multi-start fit
+
+    The first start is starting_guess if it is given, computed per star by
+    _linear_starting_guess if it is "linear" or by the model grid if it is
+    "grid"; the others are training
+    labels drawn at random, pivoted and scaled.
+
+    Returns
+    -------
+    starts: list of numpy ndarray
+        each of shape (nlabels, ) or (nstars, nlabels)
+    """
+    nlabels = len(model.pivots)
+    starts = []
+    if isinstance(starting_guess, str):
+        if starting_guess == "linear":
+            starts.append(_linear_starting_guess(
+                model, dataset.test_flux, dataset.test_ivar))
+        elif starting_guess == "grid":
+            if getattr(model, 'grid', None) is None:
+                raise ValueError("starting_guess='grid' needs a grid, "
+                                 "see CannonModel.build_grid")
+            starts.append(model.grid.starting_guesses(
+                dataset.test_flux, dataset.test_ivar))
+        else:
+            raise ValueError("unknown starting guess: %s" % starting_guess)
+    elif starting_guess is not None:
+        starts.append(np.asarray(starting_guess, dtype=float))
+    elif n_starts == 1:
+        starts.append(np.ones(nlabels))
+    if len(starts) < n_starts:
+        rng = np.random.RandomState(seed)
+        tr_label = np.asarray(dataset.tr_label)
+        choose = rng.randint(0, len(tr_label), size=n_starts-len(starts))
+        for label in tr_label[choose]:
+            starts.append((label - model.pivots) / model.scales)
+    return starts
+
+
+def _infer_labels_block(model, fluxes, ivars, starts, fit, good_redchisq):
+    """ Multi-start fit of the labels of a block of test spectra
+
+    Parameters
+    ----------
+    model: CannonModel
+        the trained model
+
+    fluxes, ivars: numpy ndarray, shape (nstars, npix)
+        test spectra
+
+    starts: list of numpy ndarray
+        starting labels of each start, see _get_starting_guesses
+
+    fit: function
+        _infer_labels_batched, _infer_labels_star or _infer_labels_parallel
+
+    good_redchisq: float
+        see _infer_labels
+
+    Returns
+    -------
+    labels_all, errs_all, chisq_all: as in _infer_labels_batched
+    """
+    nstars = fluxes.shape[0]
+    nlabels = len(model.pivots)
+    n_starts = len(starts)
+    guesses = starts[0] * np.ones((nstars, nlabels))
+    labels_all, errs_all, chisq_all = fit(model, fluxes, ivars, guesses)
+
+    if n_starts > 1:
+        # all remaining starts of the stars without a good fit, in one go
+        dof = np.maximum(np.sum(ivars > 0, axis=1) - nlabels, 1)
+        redo = np.where(chisq_all > good_redchisq * dof)[0]
+        print("%s of %s stars need %s more starts"
+              % (len(redo), nstars, n_starts-1))
+        rows = np.repeat(redo, n_starts-1)
+        guesses = np.vstack([
+            (starts[ii] * np.ones((nstars, nlabels)))[redo]
+            for ii in range(1, n_starts)])
+        # order the guesses star by star, like rows
+        guesses = guesses.reshape(n_starts-1, len(redo), nlabels)
+        guesses = guesses.swapaxes(0, 1).reshape(-1, nlabels)
+        labels, errs, chisq = fit(model, fluxes, ivars, guesses, rows)
+        chisq = chisq.reshape(len(redo), n_starts-1)
+        best = np.argmin(chisq, axis=1)
+        pick = np.arange(len(redo)) * (n_starts-1) + best
+        better = chisq[np.arange(len(redo)), best] < chisq_all[redo]
+        labels_all[redo[better]] = labels[pick[better]]
+        errs_all[redo[better]] = errs[pick[better]]
+        chisq_all[redo[better]] = chisq[np.arange(len(redo)), best][better]
+    return labels_all, errs_all, chisq_all
+
+
+def _infer_labels(model, dataset, starting_guess=None, backend="batched",
+                  n_starts=1, seed=None, good_redchisq=1.5, n_proc=1,
+                  block_size=100000):
+    """
+    Uses the model to solve for labels of the test set.
+
+    The test set is read and fit in blocks of block_size stars, so that
+    it can be a memory-mapped cube; if the dataset has an out_dir, the
+    labels, errors and chi-squareds are memory-mapped there.
+
+    Parameters
+    ----------
+    model: tuple
+        Coeffs_all, covs, scatters, chis, chisqs, pivots
+
+    dataset: Dataset
+        Dataset that needs label inference
+
+    starting_guess: numpy ndarray or str, optional
+        pivoted and scaled starting labels, shape (nlabels, ) for all stars
+        or (nstars, nlabels) for one guess per star; ones by default.
+        "linear" starts each star from the closed-form solution of the
+        model taken as linear in the label vector, "grid" from the node of
+        least chi-squared of the grid made by CannonModel.build_grid
+
+    backend: str
+        "batched" fits blocks of stars at once with Levenberg-Marquardt,
+        "star" fits one star at a time with scipy's curve_fit, using the
+        analytic Jacobian of the model
+
+    n_starts: int
+        number of starting guesses per star; the extra ones are random
+        training labels, and the fit with the lowest chi-squared is kept
+
+    seed: int, optional
+        seed for drawing the extra starting guesses
+
+    good_redchisq: float
+        stars whose first fit has a chi-squared per degree of freedom
+        below this value skip the remaining starts
+
+    n_proc: int
+        number of processes; chunks of stars are fit in parallel
+
+    block_size: int
+        number of test spectra read into memory at once
+
+    Returns
+    -------
+    errs_all:
+        Covariance matrix of the fit
+
+    chisq_all:
+        chi-squared of the fit for each star
+    """
+    print("Inferring Labels")
+    nlabels = len(dataset.get_plotting_labels())
+    nstars = dataset.test_flux.shape[0]
+
+    if backend not in ("batched", "star"):
+        raise ValueError("unknown inference backend: %s" % backend)
+    starts = _get_starting_guesses(
+            model, dataset, starting_guess, n_starts, seed)
+    out_dir = getattr(dataset, "out_dir", None)
+    labels_all = new_array((nstars, nlabels), out_dir, "test_label_vals")
+    errs_all = new_array((nstars, nlabels), out_dir, "test_label_errs")
+    chisq_all = new_array((nstars, ), out_dir, "test_chisq")
+
+    pool = None
+    if n_proc > 1:
+        # one pool and one set of shared buffers for all blocks and starts
+        block_rows = max(1, min(block_size, nstars))
+        pool = _InferencePool(model, block_rows,
+                              block_rows * max(1, len(starts) - 1),
+                              backend=backend, n_proc=n_proc)
+        fit = pool.fit
+    elif backend == "batched":
+        fit = _infer_labels_batched
+    else:
+        fit = _infer_labels_star
+    try:
+        for start, stop in iter_blocks(nstars, block_size):
+            fluxes = np.asarray(dataset.test_flux[start:stop])
+            ivars = np.asarray(dataset.test_ivar[start:stop])
+            block_starts = [guess[start:stop] if np.ndim(guess) == 2
+                            else guess for guess in starts]
+            labels, errs, chisq = _infer_labels_block(
+                    model, fluxes, ivars, block_starts, fit, good_redchisq)
+            labels_all[start:stop] = model.scales * labels + model.pivots
+            errs_all[start:stop] = errs
+            chisq_all[start:stop] = chisq
+    finally:
+        if pool is not None:
+            pool.close()
 
     dataset.set_test_label_vals(labels_all)
     return errs_all, chisq_all
-    
-    
-    
-    
-    
-    
\ No newline at end of file
@@ -0,0 +1,161 @@
+""" Joining label tables and spectra on their IDs
+
+An IDIndex sorts a column of IDs once, after which the rows of any list of
+IDs are found with one vectorized binary search, instead of an np.where
+scan of the whole column for each ID. Label files read through
+read_label_file are parsed once per session, and their ID indices are
+kept with them, so that repeated lookups do not go back to the file.
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import numpy as np
+
+__all__ = ['IDIndex', 'match_ids', 'read_label_file', 'label_file_index']
+
+
+class IDIndex(object):
+    """ Index from the IDs of a table to its rows
+
+    Parameters
+    ----------
+    ids: list or numpy ndarray
+        the ID of each row; where an ID repeats, rows gives its first row,
+        as np.where(ids == id)[0][0] would, and all_rows all of them
+    """
+    def __init__(self, ids):
+        self.ids = np.asarray(ids)
+        self._order = np.argsort(self.ids, kind='mergesort')
+        self._sorted = self.ids[self._order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return self.rows([key], missing='ignore')[0] >= 0
+
+    def rows(self, keys, missing='raise'):
+        """ Rows of the given IDs
+
+        Parameters
+        ----------
+        keys: list or numpy ndarray
+            the IDs to look up
+        missing: str
+            'raise' for a KeyError naming the IDs that are not in the
+            index, 'ignore' to return -1 for them
+
+        Returns
+        -------
+        rows: numpy ndarray of int
+        """
+        keys = np.asarray(keys)
+        if len(self._sorted) == 0:
+            found = np.zeros(keys.shape, dtype=bool)
+            rows = np.full(keys.shape, -1, dtype=int)
+        else:
+            pos = np.searchsorted(self._sorted, keys, side='left')
+            pos = np.minimum(pos, len(self._sorted)-1)
+            found = self._sorted[pos] == keys
+            rows = np.where(found, self._order[pos], -1)
+        if missing == 'raise' and not np.all(found):
+            lost = keys[~found]
+            raise KeyError("%s of %s IDs not found: %s%s"
+                           % (len(lost), len(keys),
+                              ", ".join(str(k) for k in lost[:5]),
+                              ", ..." if len(lost) > 5 else ""))
+        return rows
+
+    def all_rows(self, key):
+        """ Every row holding the given ID, in row order, as
+        np.where(ids == key)[0] """
+        lo = np.searchsorted(self._sorted, key, side='left')
+        hi = np.searchsorted(self._sorted, key, side='right')
+        # the sort is stable, so a repeated ID's rows are in order
+        return self._order[lo:hi]
+
+
+def match_ids(ids, keys, missing='raise'):
+    """ Rows of ids holding each of keys, e.g. to align labels to spectra
+
+    Equivalent to np.array([np.where(ids == k)[0][0] for k in keys]), in
+    O((N + M) log N) rather than O(N M).
+
+    Parameters
+    ----------
+    ids: list or numpy ndarray
+        IDs of the table to take rows from
+    keys: list or numpy ndarray
+        the IDs wanted, in the wanted order
+    missing: str
+        see IDIndex.rows
+
+    Returns
+    -------
+    rows: numpy ndarray of int
+    """
+    return IDIndex(ids).rows(keys, missing=missing)
+
+
+# parsed label files and their ID indices, by file and reading options
+_label_files = {}
+
+
+def _file_key(filename, *options):
+    """ Key of a file's cache entries, changed if the file changes """
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime, stat.st_size) + options
+
+
+def read_label_file(filename, usecols, dtype=str, delimiter=','):
+    """ Columns of a text label file, parsed by np.loadtxt once per session
+
+    Parameters
+    ----------
+    filename: str
+        the label file; comment lines start with #
+    usecols: int or tuple of ints
+        the columns to read
+    dtype: numpy dtype
+        type of the values
+    delimiter: str
+        the column separator
+
+    Returns
+    -------
+    values: numpy ndarray
+        as returned by np.loadtxt; do not modify it in place
+    """
+    if not isinstance(usecols, tuple):
+        usecols = tuple(np.atleast_1d(usecols).tolist())
+    key = _file_key(filename, usecols, np.dtype(dtype).str, delimiter)
+    if key not in _label_files:
+        _label_files[key] = np.loadtxt(
+                filename, usecols=usecols, dtype=dtype, delimiter=delimiter)
+    return _label_files[key]
+
+
+def label_file_index(filename, id_col=0, delimiter=',', transform=None):
+    """ IDIndex of the ID column of a label file, built once per session
+
+    Parameters
+    ----------
+    filename: str
+        the label file
+    id_col: int
+        the column holding the IDs
+    delimiter: str
+        the column separator
+    transform: function, optional
+        applied to each ID before indexing, e.g. to strip a directory
+
+    Returns
+    -------
+    index: IDIndex
+    """
+    key = _file_key(filename, 'index', id_col, delimiter, transform)
+    if key not in _label_files:
+        ids = read_label_file(filename, (id_col, ), delimiter=delimiter)
+        if transform is not None:
+            ids = np.array([transform(i) for i in ids])
+        _label_files[key] = IDIndex(ids)
+    return _label_files[key]
@@ -8,7 +8,10 @@ import os
 import sys
 import matplotlib.pyplot as plt
 import glob
+from multiprocessing.pool import ThreadPool
 from astropy.table import Table
+from .helpers.cubes import new_array
+from .join import read_label_file, label_file_index
 
 # python 3 special
 PY3 = sys.version_info[0] > 2
@@ -76,28 +79,48 @@ def get_pixmask(file_in, wl, middle, flux, ivar):
     return bad_pix_a
 
 
+def _resample(wl, vals, grid):
+    """ Linear interpolation of vals(wl) onto grid, like interp1d
+
+    Raises ValueError if the grid reaches beyond wl, as interp1d does.
+    """
+    if np.any(np.diff(wl) < 0):
+        order = np.argsort(wl, kind='mergesort')
+        wl, vals = wl[order], vals[order]
+    if len(grid) > 0 and (grid.min() < wl[0] or grid.max() > wl[-1]):
+        raise ValueError("grid [%s, %s] is outside the spectrum [%s, %s]"
+                         % (grid.min(), grid.max(), wl[0], wl[-1]))
+    return np.interp(grid, wl, vals)
+
+
 def load_spectrum(filename, grid):
     """
     Load a single spectrum
     """
-    file_in = pyfits.open(filename)
-    wl = np.array(file_in[0].data[2])
-    flux = np.array(file_in[0].data[0])
-    ivar = np.array((file_in[0].data[1]))
-    # correct for radial velocity of star
-    redshift = file_in[0].header['Z']
+    with pyfits.open(filename) as file_in:
+        wl = np.array(file_in[0].data[2])
+        flux = np.array(file_in[0].data[0])
+        ivar = np.array((file_in[0].data[1]))
+        # correct for radial velocity of star
+        redshift = file_in[0].header['Z']
     wl_shifted = wl - redshift * wl
     # resample
-    flux_rs = (interpolate.interp1d(wl_shifted, flux))(grid)
-    ivar_rs = (interpolate.interp1d(wl_shifted, ivar))(grid)
+    flux_rs = _resample(wl_shifted, flux, grid)
+    ivar_rs = _resample(wl_shifted, ivar, grid)
     ivar_rs[ivar_rs < 0] = 0. # in interpolating you can end up with neg
     return flux_rs, ivar_rs
 
 
-def load_spectra(inputf, input_grid=None):
+def load_spectra(inputf, input_grid=None, n_threads=8, out_dir=None,
+                 return_failed=False, store=None, night=None):
     """
     Extracts spectra (wavelengths, fluxes, fluxerrs) from lamost fits files
 
+    The files are read by a pool of n_threads threads, each resampling its
+    spectrum straight into its row of the output cubes. A file that cannot
+    be read or resampled is reported and left with zero flux and ivar,
+    without stopping the others.
+
     Parameters
     ----------
     inputf: np ndarray
@@ -106,6 +129,24 @@ def load_spectra(inputf, input_grid=None):
     input_grid: np ndarray
         grid onto which to interpolate
 
+    n_threads: int
+        number of files read at the same time
+
+    out_dir: str, optional
+        directory in which the flux and ivar cubes are memory-mapped,
+        as flux.npy and ivar.npy; they are kept in memory if None
+
+    return_failed: bool
+        also return the files that failed, with their errors
+
+    store: SpectralStore, optional
+        store into which the spectra are loaded, as new rows with the file
+        names as IDs; the returned cubes are views of these rows, and the
+        pixels of files that fail are masked
+
+    night: str, optional
+        name under which the rows are recorded in the store
+
     Returns
     -------
     wl: numpy ndarray of length npixels
@@ -116,11 +157,8 @@ def load_spectra(inputf, input_grid=None):
 
     ivars: numpy ndarray of shape (nstars, npixels)
         grid of inverse variances, parallel to fluxes
-        
-    npix: numpy ndarray of shape (nstars)
-        number of non-zero ivar pixels for each object
 
-    SNRs: numpy ndarray of length nstars
+    failed: list of (index, filename, error), if return_failed
     """
     print("Loading spectra...")
 
@@ -130,61 +168,97 @@ def load_spectra(inputf, input_grid=None):
     else:
         nstars = len(inputf)
 
-    npix = np.zeros(nstars) # count num of good (ivar>0) pix in each object
-
     if input_grid is None:
         # use first file as template
         if onestar:
-            file_in = pyfits.open(inputf) 
+            template = inputf
         else:
-            file_in = pyfits.open(inputf[0])
-        grid_all = np.array(file_in[0].data[2])
+            template = inputf[0]
+        with pyfits.open(template) as file_in:
+            grid_all = np.array(file_in[0].data[2])
         middle = np.logical_and(grid_all > 3905, grid_all < 9000)
         grid = grid_all[middle]
-        file_in.close()
 
     else:
         grid = input_grid
+    if store is not None and not np.array_equal(grid, store.wl):
+        raise ValueError("the grid differs from the grid of the store")
 
     # grid is the template onto which everything is interpolated
     if onestar:
         fluxes, ivars = load_spectrum(inputf, grid)
+        failed = []
 
     else:
         npixels = len(grid)
-        fluxes = np.zeros((nstars, npixels), dtype=float)
-        ivars = np.zeros(fluxes.shape, dtype=float)
-        for jj, fits_file in enumerate(inputf):
-            flux_rs, ivar_rs  = load_spectrum(fits_file, grid)
-            fluxes[jj,:] = flux_rs
-            ivars[jj,:] = ivar_rs
+        if store is None:
+            fluxes = new_array((nstars, npixels), out_dir, "flux")
+            ivars = new_array((nstars, npixels), out_dir, "ivar")
+        else:
+            rows = store.allocate(
+                    [os.path.basename(f) for f in inputf], night=night)
+            fluxes = store.flux[rows]
+            ivars = store.ivar[rows]
+
+        def load_one(jj):
+            try:
+                fluxes[jj,:], ivars[jj,:] = load_spectrum(inputf[jj], grid)
+            except Exception as err:
+                return jj, err
+            return jj, None
+
+        failed = []
+        pool = ThreadPool(processes=max(1, min(n_threads, nstars)))
+        try:
+            for jj, err in pool.imap_unordered(load_one, range(nstars)):
+                if err is not None:
+                    print("Failed to load %s: %s" % (inputf[jj], err))
+                    failed.append((jj, inputf[jj], err))
+        finally:
+            pool.close()
+            pool.join()
+        failed.sort(key=lambda item: item[0])
+        if len(failed) > 0:
+            print("%s of %s spectra failed to load" % (len(failed), nstars))
+        if store is not None:
+            masks = store.mask[rows]
+            masks[:] = ivars == 0
+            for jj, fname, err in failed:
+                masks[jj] = True
+            store.flush()
 
     print("Spectra loaded")
+    if return_failed:
+        return grid, fluxes, ivars, failed
     return grid, fluxes, ivars
 
 
+def _file_id(path):
+    """ The file name of a LAMOST spectrum, without its directory """
+    return path.split('/')[-1]
+
+
 def load_labels(lamost_ids, filename='lamost_labels_all_dates.csv'):
     """ Extracts training labels from file.
 
     Assumes that first row is # then label names, first col is # then 
     filenames, remaining values are floats and user wants all the labels.
+
+    The file is parsed and indexed once per session; a KeyError names the
+    IDs that are not in it.
     """
     print("Loading reference labels from file %s" %filename)
-    searchIn = np.loadtxt(
-        filename, usecols=(0,), delimiter=',', dtype=str)
-    all_tr_label_val = np.loadtxt(
-        filename, usecols=(1,2,3), delimiter=',', dtype=str)
-    searchIn = np.array([a.split('/')[-1] for a in searchIn])
-    inds = np.array([np.where(searchIn==a)[0][0] for a in lamost_ids])
-    return tr_labels[inds]
-
-
-def is_badstar(star_id):
-    ids = np.loadtxt(
-        "apogee_dr12_labels.csv", usecols=(0,), delimiter=',', dtype=str)
-    bad = np.loadtxt(
-        "apogee_dr12_labels.csv", usecols=(6,), delimiter=',', dtype=str)
-    return bad[ids==star_id]
+    all_tr_label_val = read_label_file(filename, (1,2,3)).astype(float)
+    index = label_file_index(filename, transform=_file_id)
+    inds = index.rows(lamost_ids)
+    return all_tr_label_val[inds]
+
+
+def is_badstar(star_id, filename="apogee_dr12_labels.csv"):
+    """ The starflags of every row of a star in the label file, which is
+    cached between calls """
+    bad = read_label_file(filename, (6, ))
+    return bad[label_file_index(filename).all_rows(star_id)]
 
 
 def get_starmask(ids, labels, aspcapflag, paramflag):
@@ -3,8 +3,14 @@ from .train_model import _train_model
 from .train_model import _train_model_new
 from .train_model import _get_lvec
 from .infer_labels import _infer_labels
+from .synthesis import _iter_spectra, _synthesize, _gradient_spectra
+from .model_grid import ModelGrid
 from .helpers.corner import corner
+from .helpers.simpletable import pretty_size_print
+from .helpers.arrayfile import write_array_file, read_array_file
 import numpy as np
+import time
+import tracemalloc
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from copy import deepcopy
@@ -13,7 +19,7 @@ plt.rc('text', usetex=True)
 plt.rc('font', family='serif')
 
 class CannonModel(object):
-    def __init__(self, order, useErrors):
+    def __init__(self, order, useErrors=False, wl_filter=None):
         self.coeffs = None
         self.scatters = None
         self.chisqs = None
@@ -24,6 +30,17 @@ class CannonModel(object):
         self.wl_filter = wl_filter
         self.model_spectra = None
         self.useErrors = useErrors
+        self.scatter_niters = None
+        self.train_peak_memory = None
+        self.wl = None
+        self.label_names = None
+        self.provenance = {}
+        self.grid = None
+
+    # arrays of a saved model, in their order in the file; chisqs, the only
+    # one of size nstars x npixels, comes last and is read only if asked for
+    _saved_arrays = ('coeffs', 'scatters', 'pivots', 'scales', 'wl',
+                     'wl_filter', 'scatter_niters', 'new_tr_labels', 'chisqs')
 
 
     def model(self):
@@ -34,19 +51,119 @@ class CannonModel(object):
             return self.coeffs
 
 
-    def train(self, ds):
-        """ Run training step: solve for best-fit spectral model """
-        if self.useErrors:
-            self.coeffs, self.scatters, self.new_tr_labels, self.chisqs, self.pivots, self.scales = _train_model_new(ds)
-        else:
-            self.coeffs, self.scatters, self.chisqs, self.pivots, self.scales = _train_model(ds)
+    def train(self, ds, backend="batched", scatter_solver="newton", n_proc=1,
+              trace_memory=False):
+        """ Run training step: solve for best-fit spectral model
+
+        Parameters
+        ----------
+        ds: Dataset
+            Dataset with the training spectra and labels
+        backend: str
+            "batched" solves all pixels at once,
+            "pixel" solves one pixel at a time
+        scatter_solver: str
+            "newton" optimizes the scatters directly,
+            "grid" scans a grid of scatter values
+        n_proc: int
+            number of processes used to fit shards of pixels in parallel
+        trace_memory: bool
+            trace allocations with tracemalloc, which slows training down,
+            and print and store in the train_peak_memory attribute the peak
+            memory allocated, in bytes; if the caller is tracing already,
+            its peak is left alone and reported, which includes training
+        """
+        tracing = tracemalloc.is_tracing()
+        if trace_memory and not tracing:
+            tracemalloc.start()
+        try:
+            if self.useErrors:
+                self.coeffs, self.scatters, self.new_tr_labels, self.chisqs, self.pivots, self.scales = _train_model_new(ds)
+            else:
+                self.coeffs, self.scatters, self.chisqs, self.pivots, self.scales, self.scatter_niters = _train_model(
+                        ds, self.wl_filter, backend=backend,
+                        scatter_solver=scatter_solver, n_proc=n_proc)
+            if trace_memory:
+                self.train_peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            if trace_memory and not tracing:
+                tracemalloc.stop()
+        if trace_memory:
+            print("Peak memory allocated during training: %s"
+                  % pretty_size_print(self.train_peak_memory))
+        self.wl = np.array(ds.wl, dtype=float)
+        if ds.get_plotting_labels() is not None:
+            self.label_names = [str(l) for l in ds.get_plotting_labels()]
+        tr_label = np.asarray(ds.tr_label, dtype=float)
+        self.provenance = {
+                'trained': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                'n_tr_stars': int(tr_label.shape[0]),
+                'tr_label_min': tr_label.min(axis=0).tolist(),
+                'tr_label_max': tr_label.max(axis=0).tolist(),
+                'backend': backend, 'scatter_solver': scatter_solver,
+                'train_peak_memory': self.train_peak_memory}
+
+    def save(self, path, provenance=None):
+        """ Save the trained model to a single file
+
+        The coefficients, scatters, pivots, scales and wavelength grid are
+        stored as raw arrays that CannonModel.load maps without copying,
+        with the label names and training provenance in the file header.
+
+        Parameters
+        ----------
+        path: str
+            the file to write
+        provenance: dict, optional
+            more JSON-serializable entries for the provenance, e.g. the
+            files the training set was read from
+        """
+        self.model()
+        arrays = [(name, getattr(self, name)) for name in self._saved_arrays
+                  if getattr(self, name) is not None]
+        meta = {'order': self.order, 'useErrors': self.useErrors,
+                'label_names': self.label_names,
+                'provenance': dict(self.provenance, **(provenance or {}))}
+        write_array_file(path, arrays, meta)
+
+    @classmethod
+    def load(cls, path, mmap=True, chisqs=False):
+        """ Load a model saved by CannonModel.save
+
+        Parameters
+        ----------
+        path: str
+            the file
+        mmap: bool
+            map the arrays read-only from the file instead of reading them,
+            so that loading costs no time or memory whatever their size
+        chisqs: bool
+            also load the chi-squareds of the training spectra, which are
+            only needed for diagnostics
+
+        Returns
+        -------
+        model: CannonModel
+        """
+        names = [name for name in cls._saved_arrays
+                 if chisqs or name != 'chisqs']
+        arrays, meta = read_array_file(path, names=names, mmap=mmap)
+        m = cls(meta['order'], useErrors=meta['useErrors'])
+        for name, arr in arrays.items():
+            setattr(m, name, arr)
+        m.label_names = meta['label_names']
+        m.provenance = meta['provenance']
+        m.train_peak_memory = m.provenance.get('train_peak_memory')
+        return m
 
     def diagnostics(self):
         """ Produce a set of diagnostics plots about the model. """
         _model_diagnostics(self.dataset, self.model)
 
 
-    def infer_labels(self, ds, starting_guess = None):
+    def infer_labels(self, ds, starting_guess = None, backend="batched",
+                     n_starts=1, seed=None, good_redchisq=1.5, n_proc=1,
+                     block_size=100000):
         """
         Uses the model to solve for labels of the test set, updates Dataset
         Then use those inferred labels to set the model.test_spectra attribute
@@ -55,27 +172,163 @@ class CannonModel(object):
         ----------
         ds: Dataset
             Dataset that needs label inference
+        starting_guess: ndarray or str
+            Pivoted and scaled starting labels, for all stars or one per star;
+            "linear" computes a closed-form guess for each star, "grid"
+            takes the nearest node of the grid made by build_grid
+        backend: str
+            "batched" fits blocks of stars at once,
+            "star" fits one star at a time with curve_fit
+        n_starts: int
+            Number of starting guesses per star, the best fit is kept;
+            the extra guesses are random training labels
+        seed: int
+            Seed for drawing the extra starting guesses
+        good_redchisq: float
+            Stars whose first fit reaches this reduced chi-squared
+            skip the remaining starts
+        n_proc: int
+            Number of processes fitting chunks of stars in parallel
+        block_size: int
+            Number of test spectra read into memory at once, so that
+            the test set can be a memory-mapped cube
 
         Returns
         -------
         errs_all: ndarray
             Covariance matrix of the fit
+        chisq_all: ndarray
+            Chi-squared of the fit for each star
         """
-        return _infer_labels(self, ds, starting_guess)
+        return _infer_labels(self, ds, starting_guess, backend=backend,
+                             n_starts=n_starts, seed=seed,
+                             good_redchisq=good_redchisq, n_proc=n_proc,
+                             block_size=block_size)
 
 
-    def infer_spectra(self, ds):
+    def infer_spectra(self, ds, outputs=("model", ), block_size=1000):
         """ 
         After inferring labels for the test spectra,
         infer the model spectra and update the dataset
         model_spectra attribute.
+
+        The spectra are computed block by block; if the dataset has an
+        out_dir, the outputs are memory-mapped there instead of held in
+        memory.
         
         Parameters
         ----------
         ds: Dataset object
+        outputs: sequence of str
+            any of "model" for the model spectra, "resid" for the test
+            fluxes minus the model spectra, and "chi" for the residuals
+            over their uncertainties
+        block_size: int
+            number of stars computed at once
+
+        Returns
+        -------
+        out: dict
+            the requested arrays by name, [nstars, npix] each
+        """
+        out = _synthesize(self, ds.test_label_vals, ds.test_flux,
+                          ds.test_ivar, outputs=outputs,
+                          out_dir=getattr(ds, 'out_dir', None),
+                          block_size=block_size)
+        self.model_spectra = out.get("model")
+        return out
+
+
+    def iter_spectra(self, ds, residuals=True, block_size=1000):
+        """ Iterate over blocks of model spectra of the test set
+
+        Nothing of size nstars x npix is allocated, so residuals or
+        statistics of the whole test set can be accumulated block by
+        block.
+
+        Parameters
+        ----------
+        ds: Dataset object
+            with test_label_vals set, e.g. by infer_labels
+        residuals: bool
+            also compute the residuals and chi of the test spectra
+        block_size: int
+            number of stars in a block
+
+        Yields
+        ------
+        start, stop: int
+            the rows of the block
+        model_flux, resid, chi: ndarray
+            model spectra of the block, the test fluxes minus the model
+            spectra, and the residuals over their uncertainties; resid and
+            chi are None unless residuals is set
+        """
+        if residuals:
+            fluxes, ivars = ds.test_flux, ds.test_ivar
+        else:
+            fluxes, ivars = None, None
+        return _iter_spectra(self, ds.test_label_vals, fluxes, ivars,
+                             block_size=block_size)
+
+
+    def gradient_spectra(self, labels):
+        """ Exact derivatives of the model spectrum with respect to the labels
+
+        Parameters
+        ----------
+        labels: ndarray
+            labels of the reference points, [nref, nlabels], or of one
+            point, [nlabels]
+
+        Returns
+        -------
+        grad: ndarray
+            d(flux)/d(label) at each point, [nref, npix, nlabels], in flux
+            per unit of each label
+        """
+        self.model()
+        return _gradient_spectra(self.coeffs, labels, self.pivots, self.scales)
+
+
+    def build_grid(self, n_nodes=5, bounds=None, out_dir=None,
+                   block_size=1000):
+        """ Precompute model spectra on a regular grid of labels
+
+        The grid interpolates model spectra with an error bound, see
+        ModelGrid.model_spectrum, and gives the starting_guess="grid" of
+        infer_labels. It is kept in the grid attribute.
+
+        Parameters
+        ----------
+        n_nodes: int or sequence of int
+            number of nodes along every label, or along each label
+        bounds: tuple of ndarray, optional
+            lowest and highest node of each label; by default the range of
+            the training labels, or pivots -/+ 2 scales if it is unknown
+        out_dir: str, optional
+            directory in which the node spectra are memory-mapped
+        block_size: int
+            number of node spectra computed at once
+
+        Returns
+        -------
+        grid: ModelGrid
         """
-        lvec_all = _get_lvec(ds.test_label_vals, self.pivots, self.scales, derivs=False)
-        self.model_spectra = np.dot(lvec_all, self.coeffs.T)
+        self.model()
+        if bounds is None:
+            if 'tr_label_min' in self.provenance:
+                bounds = (self.provenance['tr_label_min'],
+                          self.provenance['tr_label_max'])
+            else:
+                scales = self.scales if self.scales is not None else 1.
+                bounds = (self.pivots - 2. * scales, self.pivots + 2. * scales)
+        low, high = (np.asarray(b, dtype=float) for b in bounds)
+        n_nodes = np.broadcast_to(n_nodes, low.shape)
+        axes = [np.linspace(lo, hi, n) for lo, hi, n in zip(low, high, n_nodes)]
+        self.grid = ModelGrid(self, axes, out_dir=out_dir,
+                              block_size=block_size)
+        return self.grid
 
 
     def plot_contpix(self, x, y, contpix_x, contpix_y, figname):
@@ -0,0 +1,216 @@
+""" Model spectra precomputed on a regular grid of labels
+
+The nodes of a ModelGrid span a box in label space, by default that of the
+training labels, and their spectra are computed once, in blocks, into an
+array that can be memory-mapped from disk. The grid then gives
+
+* model spectra at any labels by multilinear interpolation between the
+  2**nlabels surrounding nodes, with an error bound: the model is quadratic
+  in the labels and multilinear interpolation is exact for all its terms but
+  the squares, so the error at each pixel is at most
+  sum_k |c_kk| t_k (h_k - t_k) / s_k**2, for a point at t_k from a node
+  along label k in a cell of width h_k; at most sum_k |c_kk| h_k**2 / 4 s_k**2
+  anywhere in the grid.
+* the node of least chi-squared for each observed spectrum, found with
+  matrix products over blocks of nodes, as a starting guess for the fit.
+
+For a few labels interpolation costs about as much as evaluating the
+quadratic model, which CannonModel.infer_spectra does; the grid pays off
+when the same spectra are looked up again and again, and for the guesses.
+"""
+from __future__ import (absolute_import, division, print_function)
+from itertools import product
+import numpy as np
+from .train_model import _get_lvec_tables
+from .synthesis import _iter_spectra
+from .helpers.cubes import load_cube, new_array, iter_blocks
+
+__all__ = ['ModelGrid']
+
+
+class ModelGrid(object):
+    """ Model spectra on a regular grid of labels
+
+    Parameters
+    ----------
+    model: CannonModel
+        the trained model
+    axes: list of numpy ndarray
+        the increasing node values of each label, at least two per label
+    out_dir: str, optional
+        directory in which the node spectra are memory-mapped as
+        model_grid.npy; they are kept in memory if None
+    flux: numpy ndarray or str, optional
+        node spectra computed before for the same model and axes, e.g. the
+        path of a model_grid.npy; they are computed if None
+    block_size: int
+        number of spectra computed or compared at once
+    """
+    def __init__(self, model, axes, out_dir=None, flux=None,
+                 block_size=1000):
+        self.axes = [np.asarray(a, dtype=float) for a in axes]
+        if len(self.axes) != len(model.pivots):
+            raise ValueError("the grid needs one axis per label")
+        if any(len(a) < 2 or np.any(np.diff(a) <= 0) for a in self.axes):
+            raise ValueError("grid axes need at least two increasing nodes")
+        self.shape = tuple(len(a) for a in self.axes)
+        self.pivots = np.asarray(model.pivots, dtype=float)
+        if model.scales is None:
+            self.scales = np.ones(len(self.pivots))
+        else:
+            self.scales = np.asarray(model.scales, dtype=float)
+        self.scatters = np.asarray(model.scatters, dtype=float)
+        self.block_size = block_size
+        nnodes = int(np.prod(self.shape))
+        npix = len(self.scatters)
+
+        if flux is None:
+            self.flux = new_array((nnodes, npix), out_dir, "model_grid")
+            nodes = _GridNodes(self)
+            for start, stop, model_flux, _, _ in _iter_spectra(
+                    model, nodes, block_size=block_size):
+                self.flux[start:stop] = model_flux
+        else:
+            self.flux = load_cube(flux)
+            if self.flux.shape != (nnodes, npix):
+                raise ValueError("node spectra of shape %s do not match a "
+                                 "grid of %s nodes and %s pixels"
+                                 % (self.flux.shape, nnodes, npix))
+
+        # coefficients of the squared labels, per unit of each label
+        nlabels = len(self.axes)
+        term_idx = _get_lvec_tables(nlabels, 2)[0]
+        squares = [np.where((term_idx[:, 0] == k) & (term_idx[:, 1] == k))[0][0]
+                   for k in range(nlabels)]
+        self._curvature = (np.abs(np.asarray(model.coeffs)[:, squares])
+                           / self.scales**2)
+        widths = np.array([np.max(np.diff(a)) for a in self.axes])
+        self.max_error = np.max(np.dot(self._curvature, widths**2 / 4.))
+
+    def __len__(self):
+        return len(self.flux)
+
+    def node_labels(self, nodes):
+        """ Labels of the nodes with the given flat indices """
+        idx = np.unravel_index(np.asarray(nodes), self.shape)
+        return np.column_stack([a[i] for a, i in zip(self.axes, idx)])
+
+    def _cells(self, labels):
+        """ Lower node and offset along each label of each point """
+        lower = np.empty(labels.shape, dtype=int)
+        offset = np.empty(labels.shape)
+        width = np.empty(labels.shape)
+        for k, a in enumerate(self.axes):
+            i = np.clip(np.searchsorted(a, labels[:, k], side='right') - 1,
+                        0, len(a) - 2)
+            lower[:, k] = i
+            offset[:, k] = labels[:, k] - a[i]
+            width[:, k] = a[i + 1] - a[i]
+        return lower, offset, width
+
+    def model_spectrum(self, labels, return_error=False):
+        """ Model spectra at the given labels, interpolated on the grid
+
+        Points outside the grid are extrapolated from the nearest cell;
+        the error bound holds there too.
+
+        Parameters
+        ----------
+        labels: numpy ndarray
+            labels of the points, [npoints, nlabels] or [nlabels]
+        return_error: bool
+            also return a bound on the interpolation error of each point
+
+        Returns
+        -------
+        fluxes: ndarray
+            the interpolated spectra, [npoints, npix]
+        error: ndarray
+            the largest error of any pixel of each point, [npoints]
+        """
+        labels = np.atleast_2d(np.asarray(labels, dtype=float))
+        nlabels = len(self.axes)
+        fluxes = np.zeros((len(labels), self.flux.shape[1]))
+        error = np.zeros(len(labels))
+        for start, stop in iter_blocks(len(labels), self.block_size):
+            lower, offset, width = self._cells(labels[start:stop])
+            frac = offset / width
+            for corner in product((0, 1), repeat=nlabels):
+                corner = np.array(corner)
+                weight = np.prod(np.where(corner, frac, 1. - frac), axis=1)
+                nodes = np.ravel_multi_index((lower + corner).T, self.shape)
+                fluxes[start:stop] += weight[:, None] * self.flux[nodes]
+            if return_error:
+                spread = np.abs(offset * (width - offset))
+                error[start:stop] = np.max(
+                        np.dot(spread, self._curvature.T), axis=1)
+        if return_error:
+            return fluxes, error
+        return fluxes
+
+    def nearest(self, fluxes, ivars):
+        """ The node of least chi-squared for each spectrum
+
+        The chi-squared of every star against a block of nodes is
+        sum(w f**2) - 2 (w f) M.T + w (M**2).T, for weights w, fluxes f
+        and node spectra M, two matrix products per block. The weights
+        are those of the label fit.
+
+        Parameters
+        ----------
+        fluxes, ivars: numpy ndarray
+            the spectra, [nstars, npix]
+
+        Returns
+        -------
+        labels: ndarray
+            labels of the best node of each star, [nstars, nlabels]
+        chisq: ndarray
+            its chi-squared, [nstars]
+        """
+        nstars = len(fluxes)
+        best = np.zeros(nstars, dtype=int)
+        chisq = np.zeros(nstars)
+        for start, stop in iter_blocks(nstars, self.block_size):
+            flux = np.array(fluxes[start:stop], dtype=float)
+            ivar = np.array(ivars[start:stop], dtype=float)
+            # where the ivar == 0, set the flux to 1 and the sigma to 100
+            bad = ivar == 0
+            flux[bad] = 1.0
+            sigma2 = np.ones(ivar.shape) * 100.0**2
+            sigma2[~bad] = 1.0 / ivar[~bad]
+            weights = 1. / (sigma2 + self.scatters**2)
+            wflux = weights * flux
+            base = np.sum(wflux * flux, axis=1)
+            block_chisq = np.full(stop - start, np.inf)
+            block_best = np.zeros(stop - start, dtype=int)
+            for n0, n1 in iter_blocks(len(self), self.block_size):
+                nodes = np.asarray(self.flux[n0:n1])
+                chi2 = (base[:, None] - 2. * np.dot(wflux, nodes.T)
+                        + np.dot(weights, (nodes**2).T))
+                pick = np.argmin(chi2, axis=1)
+                value = chi2[np.arange(len(pick)), pick]
+                better = value < block_chisq
+                block_chisq[better] = value[better]
+                block_best[better] = n0 + pick[better]
+            best[start:stop] = block_best
+            chisq[start:stop] = block_chisq
+        return self.node_labels(best), chisq
+
+    def starting_guesses(self, fluxes, ivars):
+        """ Pivoted and scaled labels of the nearest node of each spectrum,
+        as taken by CannonModel.infer_labels """
+        labels, _ = self.nearest(fluxes, ivars)
+        return (labels - self.pivots) / self.scales
+
+
+class _GridNodes(object):
+    """ The labels of the nodes of a grid, made a block at a time """
+    def __init__(self, grid):
+        self.grid = grid
+
+    def __len__(self):
+        return int(np.prod(self.grid.shape))
+
+    def __getitem__(self, rows):
+        return self.grid.node_labels(np.arange(*rows.indices(len(self))))
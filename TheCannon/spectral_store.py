@@ -0,0 +1,348 @@
+""" On-disk store of the spectra of a survey, with an index of their IDs
+
+A store is a directory holding a wavelength grid and, for every spectrum,
+a row of flux, ivar and bad-pixel mask, and its ID. The rows are raw
+memory-mapped files that grow in chunks of rows as nights are appended,
+so that any range of rows is a zero-copy view. A hash table on disk maps
+each ID to its row, so that fetching k spectra by ID costs O(k) however
+large the store is.
+
+    store = SpectralStore.create("lamost_dr2", wl)
+    lamost.load_spectra(files, input_grid=wl, store=store, night="20121115")
+    ...
+    store = SpectralStore("lamost_dr2")
+    flux, ivar, mask = store.fetch(tr_ids)
+    rows = store.night_rows("20121115")
+    test_flux = store.flux[rows]
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import json
+import hashlib
+import numpy as np
+
+__all__ = ['SpectralStore']
+
+_META = "meta.json"
+_EMPTY = -1
+
+
+def _encode_ids(ids, width):
+    """ IDs as a fixed-width bytes array """
+    ids = [i if isinstance(i, bytes) else str(i).encode('utf-8')
+           for i in np.atleast_1d(ids)]
+    if any(len(i) > width for i in ids):
+        raise ValueError("IDs longer than %s bytes cannot be stored" % width)
+    return np.array(ids, dtype='S%d' % width)
+
+
+def _hash_ids(ids):
+    """ Hashes of the encoded IDs, the same in every session and version """
+    return np.array([int(hashlib.md5(i).hexdigest()[:15], 16) for i in ids],
+                    dtype=np.int64)
+
+
+class SpectralStore(object):
+    """ Spectra, masks and IDs of a survey, memory-mapped from a directory
+
+    Parameters
+    ----------
+    path: str
+        directory of an existing store, see SpectralStore.create
+    mode: str
+        'r' to read, 'r+' to also append
+    """
+    def __init__(self, path, mode='r'):
+        if mode not in ('r', 'r+'):
+            raise ValueError("mode must be 'r' or 'r+'")
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, _META)) as f:
+            self._meta = json.load(f)
+        self.wl = np.load(os.path.join(path, "wl.npy"))
+        self._map()
+
+    @classmethod
+    def create(cls, path, wl, id_width=64, chunk_rows=1024, dtype=float):
+        """ Create an empty store for spectra on the grid wl
+
+        Parameters
+        ----------
+        path: str
+            directory of the store, created if needed; must not hold a store
+        wl: numpy ndarray
+            the wavelength grid of every spectrum
+        id_width: int
+            the longest ID, in bytes
+        chunk_rows: int
+            the files grow by this many rows at a time
+        dtype: numpy dtype
+            data type of flux and ivar
+
+        Returns
+        -------
+        store: SpectralStore
+            opened for appending
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if os.path.exists(os.path.join(path, _META)):
+            raise ValueError("a store already exists in %s" % path)
+        wl = np.asarray(wl, dtype=float)
+        np.save(os.path.join(path, "wl.npy"), wl)
+        meta = {'npix': len(wl), 'dtype': np.dtype(dtype).str,
+                'id_width': int(id_width), 'chunk_rows': int(chunk_rows),
+                'nrows': 0, 'capacity': 0, 'index_size': 0, 'nights': []}
+        with open(os.path.join(path, _META), 'w') as f:
+            json.dump(meta, f)
+        store = cls(path, mode='r+')
+        store._grow(chunk_rows)
+        return store
+
+    # layout of the row files: name, dtype and row shape
+    def _layout(self):
+        meta = self._meta
+        npix = meta['npix']
+        return [("flux", np.dtype(meta['dtype']), (npix, )),
+                ("ivar", np.dtype(meta['dtype']), (npix, )),
+                ("mask", np.dtype(bool), (npix, )),
+                ("ids", np.dtype('S%d' % meta['id_width']), ()),
+                ("hashes", np.dtype(np.int64), ())]
+
+    def _map(self):
+        """ Map the row files and the index """
+        capacity = self._meta['capacity']
+        for name, dtype, shape in self._layout():
+            if capacity == 0:
+                arr = np.zeros((0, ) + shape, dtype=dtype)
+            else:
+                arr = np.memmap(os.path.join(self.path, name + ".dat"),
+                                dtype=dtype, mode=self.mode,
+                                shape=(capacity, ) + shape)
+            setattr(self, "_" + name, arr)
+        size = self._meta['index_size']
+        if size == 0:
+            self._index = np.zeros(0, dtype=np.int64)
+        else:
+            self._index = np.memmap(os.path.join(self.path, "index.dat"),
+                                    dtype=np.int64, mode=self.mode,
+                                    shape=(size, ))
+
+    def _save_meta(self):
+        tmp = os.path.join(self.path, _META + ".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(self._meta, f)
+        os.rename(tmp, os.path.join(self.path, _META))
+
+    def _grow(self, nrows):
+        """ Make room for at least nrows rows, a whole number of chunks """
+        chunk = self._meta['chunk_rows']
+        capacity = -(-nrows // chunk) * chunk
+        if capacity <= self._meta['capacity']:
+            return
+        self.flush()
+        for name, dtype, shape in self._layout():
+            fname = os.path.join(self.path, name + ".dat")
+            with open(fname, 'ab') as f:
+                f.truncate(capacity * dtype.itemsize * int(np.prod(shape)))
+        self._meta['capacity'] = capacity
+        self._map()
+        if capacity > self._meta['index_size'] // 2:
+            self._rebuild_index(4 * capacity)
+        self._save_meta()
+
+    def _rebuild_index(self, size):
+        """ Rebuild the ID hash table with size slots from the row hashes """
+        fname = os.path.join(self.path, "index.dat")
+        index = np.memmap(fname, dtype=np.int64, mode='w+', shape=(size, ))
+        index[:] = _EMPTY
+        self._index = index
+        self._meta['index_size'] = size
+        nrows = self._meta['nrows']
+        self._insert(np.arange(nrows), self._hashes[:nrows])
+
+    def _insert(self, rows, hashes):
+        """ Add rows to the hash table, by linear probing """
+        size = len(self._index)
+        slots = hashes % size
+        while len(rows) > 0:
+            # of the rows probing the same free slot, the first takes it
+            free = self._index[slots] == _EMPTY
+            first = np.zeros(len(rows), dtype=bool)
+            _, take = np.unique(slots[free], return_index=True)
+            first[np.where(free)[0][take]] = True
+            self._index[slots[first]] = rows[first]
+            rows, slots = rows[~first], (slots[~first] + 1) % size
+
+    def _lookup(self, ids, hashes):
+        """ Rows of the encoded ids, -1 for the ones not in the store """
+        size = len(self._index)
+        found = np.full(len(ids), -1, dtype=np.int64)
+        if size == 0:
+            return found
+        todo = np.arange(len(ids))
+        slots = hashes % size
+        while len(todo) > 0:
+            rows = self._index[slots]
+            empty = rows == _EMPTY
+            hit = ~empty
+            hit[hit] = ((self._hashes[rows[hit]] == hashes[todo[hit]]) &
+                        (self._ids[rows[hit]] == ids[todo[hit]]))
+            found[todo[hit]] = rows[hit]
+            more = ~(hit | empty)
+            todo, slots = todo[more], (slots[more] + 1) % size
+        return found
+
+    def __len__(self):
+        return self._meta['nrows']
+
+    @property
+    def flux(self):
+        """ Flux of every row, a memory-mapped view """
+        return self._flux[:len(self)]
+
+    @property
+    def ivar(self):
+        """ Inverse variance of every row, a memory-mapped view """
+        return self._ivar[:len(self)]
+
+    @property
+    def mask(self):
+        """ Bad-pixel mask of every row, True for bad pixels """
+        return self._mask[:len(self)]
+
+    @property
+    def ids(self):
+        """ ID of every row """
+        return np.char.decode(self._ids[:len(self)], 'utf-8')
+
+    @property
+    def nights(self):
+        """ Names of the appended nights, in order """
+        return [night for night, start, stop in self._meta['nights']]
+
+    def night_rows(self, night):
+        """ The slice of rows appended as night """
+        for name, start, stop in self._meta['nights']:
+            if name == night:
+                return slice(start, stop)
+        raise KeyError("no night %s in the store" % night)
+
+    def allocate(self, ids, night=None):
+        """ Add rows for new IDs, with zero flux, ivar and mask
+
+        The rows are indexed at once; fill them through the flux, ivar and
+        mask views, e.g. as a loader does.
+
+        Parameters
+        ----------
+        ids: list or numpy ndarray
+            IDs of the new spectra; must be new and distinct
+        night: str, optional
+            name under which the rows are recorded
+
+        Returns
+        -------
+        rows: slice
+            the new rows
+        """
+        if self.mode != 'r+':
+            raise IOError("the store is opened read-only")
+        ids = _encode_ids(ids, self._meta['id_width'])
+        if len(np.unique(ids)) < len(ids):
+            raise ValueError("IDs to append are not distinct")
+        hashes = _hash_ids(ids)
+        known = self._lookup(ids, hashes) >= 0
+        if known.any():
+            raise ValueError("%s IDs are in the store already, e.g. %s"
+                             % (known.sum(), ids[known][0].decode('utf-8')))
+        if night is not None and night in self.nights:
+            raise ValueError("night %s is in the store already" % night)
+        start = len(self)
+        stop = start + len(ids)
+        self._grow(stop)
+        self._ids[start:stop] = ids
+        self._hashes[start:stop] = hashes
+        self._insert(np.arange(start, stop), hashes)
+        self._meta['nrows'] = stop
+        if night is not None:
+            self._meta['nights'].append([night, start, stop])
+        self.flush()
+        return slice(start, stop)
+
+    def append(self, ids, fluxes, ivars, masks=None, night=None):
+        """ Append spectra, e.g. those of a night
+
+        Parameters
+        ----------
+        ids: list or numpy ndarray
+            IDs of the new spectra; must be new and distinct
+        fluxes, ivars: numpy ndarray of shape (nstars, npixels)
+            the spectra, on the grid of the store
+        masks: numpy ndarray of shape (nstars, npixels), optional
+            bad-pixel masks; ivars == 0 if None
+        night: str, optional
+            name under which the rows are recorded
+
+        Returns
+        -------
+        rows: slice
+            the new rows
+        """
+        fluxes = np.atleast_2d(fluxes)
+        ivars = np.atleast_2d(ivars)
+        if fluxes.shape[1] != self._meta['npix']:
+            raise ValueError("spectra have %s pixels, the store %s"
+                             % (fluxes.shape[1], self._meta['npix']))
+        if masks is None:
+            masks = ivars == 0
+        rows = self.allocate(ids, night=night)
+        self._flux[rows] = fluxes
+        self._ivar[rows] = ivars
+        self._mask[rows] = masks
+        self.flush()
+        return rows
+
+    def rows_of(self, ids, missing='raise'):
+        """ Rows of the given IDs
+
+        Parameters
+        ----------
+        ids: list or numpy ndarray
+            the IDs to look up
+        missing: str
+            'raise' for a KeyError if an ID is not in the store,
+            'ignore' to return -1 for it
+
+        Returns
+        -------
+        rows: numpy ndarray of int
+        """
+        ids = _encode_ids(ids, self._meta['id_width'])
+        rows = self._lookup(ids, _hash_ids(ids))
+        if missing == 'raise' and np.any(rows < 0):
+            lost = ids[rows < 0]
+            raise KeyError("%s IDs are not in the store, e.g. %s"
+                           % (len(lost), lost[0].decode('utf-8')))
+        return rows
+
+    def fetch(self, ids):
+        """ Flux, ivar and mask of the given IDs, in their order
+
+        Returns
+        -------
+        fluxes, ivars, masks: numpy ndarray of shape (len(ids), npixels)
+        """
+        rows = self.rows_of(ids)
+        return self._flux[rows], self._ivar[rows], self._mask[rows]
+
+    def flush(self):
+        """ Write the mapped rows and the index to disk """
+        for name, dtype, shape in self._layout():
+            arr = getattr(self, "_" + name)
+            if isinstance(arr, np.memmap) and self.mode == 'r+':
+                arr.flush()
+        if isinstance(self._index, np.memmap) and self.mode == 'r+':
+            self._index.flush()
+        if self.mode == 'r+':
+            self._save_meta()
@@ -0,0 +1,130 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+
+import numpy as np
+from .train_model import _get_lvec
+from .helpers.cubes import new_array, iter_blocks
+
+# the outputs of _synthesize, and the names of their files in an out_dir
+_OUTPUTS = {'model': "model_spectra", 'resid': "model_residuals",
+            'chi': "model_chi"}
+
+
+def _iter_spectra(model, labels, fluxes=None, ivars=None, block_size=1000):
+    """
+    Model spectra of blocks of stars, with their residuals and chi
+
+    Only one block of model spectra is held in memory at a time, so that
+    the labels and spectra can be those of a whole survey, e.g. as
+    memory-mapped cubes.
+
+    Parameters
+    ----------
+    model: CannonModel
+        the trained model
+    labels: numpy ndarray
+        labels of the stars, [nstars, nlabels]
+    fluxes, ivars: numpy ndarray, optional
+        the observed spectra, [nstars, npix]; the residuals need fluxes,
+        chi needs both
+    block_size: int
+        number of stars in a block
+
+    Yields
+    ------
+    start, stop: int
+        the rows of the block
+    model_flux: ndarray
+        model spectra of the block, [stop-start, npix]
+    resid: ndarray or None
+        fluxes minus model spectra
+    chi: ndarray or None
+        residuals over their uncertainty, the data and the model scatter
+        added in quadrature; zero where ivar is zero
+    """
+    coeffs_T = np.asarray(model.coeffs).T
+    scatters2 = np.asarray(model.scatters)**2
+    for start, stop in iter_blocks(len(labels), block_size):
+        lvec = _get_lvec(np.asarray(labels[start:stop], dtype=float),
+                         model.pivots, model.scales, derivs=False)
+        model_flux = np.dot(lvec, coeffs_T)
+        resid = None
+        chi = None
+        if fluxes is not None:
+            resid = np.asarray(fluxes[start:stop]) - model_flux
+            if ivars is not None:
+                ivar = np.asarray(ivars[start:stop])
+                chi = resid * np.sqrt(ivar / (1. + ivar * scatters2))
+        yield start, stop, model_flux, resid, chi
+
+
+def _synthesize(model, labels, fluxes=None, ivars=None, outputs=("model", ),
+                out_dir=None, block_size=1000):
+    """
+    Write the model spectra of all stars, or their residuals and chi, to
+    output arrays, one block of stars at a time
+
+    Parameters
+    ----------
+    model, labels, fluxes, ivars, block_size: as in _iter_spectra
+    outputs: sequence of str
+        any of "model", "resid" and "chi"
+    out_dir: str, optional
+        directory in which the outputs are memory-mapped as
+        model_spectra.npy, model_residuals.npy and model_chi.npy;
+        they are kept in memory if None
+
+    Returns
+    -------
+    out: dict
+        the output arrays by name, [nstars, npix] each
+    """
+    for name in outputs:
+        if name not in _OUTPUTS:
+            raise ValueError("unknown output: %s" % name)
+    if fluxes is None and ("resid" in outputs or "chi" in outputs):
+        raise ValueError("residuals and chi need the observed fluxes")
+    if ivars is None and "chi" in outputs:
+        raise ValueError("chi needs the observed ivars")
+    shape = (len(labels), len(model.scatters))
+    out = dict((name, new_array(shape, out_dir, _OUTPUTS[name]))
+               for name in outputs)
+    if "resid" not in outputs and "chi" not in outputs:
+        fluxes = None
+    if "chi" not in outputs:
+        ivars = None
+    for start, stop, model_flux, resid, chi in _iter_spectra(
+            model, labels, fluxes, ivars, block_size):
+        blocks = {'model': model_flux, 'resid': resid, 'chi': chi}
+        for name in outputs:
+            out[name][start:stop] = blocks[name]
+    return out
+
+
+def _gradient_spectra(coeffs, labels, pivots, scales=None):
+    """
+    Derivatives of the model spectra with respect to each label
+
+    The model is a polynomial in the labels, so the derivatives are exact:
+    the coefficients times the derivatives of the label vector, divided by
+    the scales of the labels.
+
+    Parameters
+    ----------
+    coeffs: numpy ndarray
+        coefficients of the model, [npix, nterms]
+    labels: numpy ndarray
+        labels of the reference points, [nref, nlabels] or [nlabels]
+    pivots, scales: numpy ndarray
+        as in _get_lvec; scales are ones if None
+
+    Returns
+    -------
+    grad: ndarray
+        d(flux)/d(label), [nref, npix, nlabels]
+    """
+    labels = np.atleast_2d(np.asarray(labels, dtype=float))
+    if scales is None:
+        scales = np.ones(labels.shape[1])
+    lvec, dlvec = _get_lvec(labels, np.asarray(pivots, dtype=float),
+                            np.asarray(scales, dtype=float), derivs=True)
+    return np.matmul(np.asarray(coeffs), dlvec) / scales
@@ -4,6 +4,10 @@ import matplotlib.pyplot as plt
 from .helpers.compatibility import range, map
 from .helpers.corner import corner
 import scipy.optimize as op
+import multiprocessing as mp
+from itertools import repeat, combinations_with_replacement
+from .helpers.sharedmem import (SharedArray, blas_thread_env,
+                                limit_blas_threads, blas_threads_per_proc)
 
 def training_step_objective_function(pars, fluxes, ivars, lvec, lvec_derivs, ldelta_vec, Nstars, Nlabels, Npix):
     """
@@ -133,12 +137,12 @@ def _train_model_new(ds):
     #lams = ds.wl
     #npixels = len(lams)
     fluxes = ds.tr_flux
-    ivars = ds.tr_ivar
     ldelta = ds.tr_delta
     
     # for training, ivar can't be zero, otherwise you get singular matrices
     # DWH says: make sure no ivar goes below 1 or 0.01
-    ivars[ivars<0.01] = 0.01
+    # clip a copy: ds.tr_ivar may be read-only or mapped from a file
+    ivars = np.maximum(ds.tr_ivar, 0.01)
 
     pivots, scales = get_pivots_and_scales(label_vals) 
     lvec, lvec_derivs = _get_lvec(label_vals, pivots, scales, derivs=True)
@@ -157,7 +161,8 @@ def _train_model_new(ds):
     
     # this gives delta_nk; same as lvec, but for uncertainties on lables
     linear_offsets = scaled_ldelta
-    quadratic_offsets = np.array([np.outer(m, m)[np.triu_indices(label_vals.shape[1])]for m in (linear_offsets)]) * 10
+    nlab = label_vals.shape[1]
+    quadratic_offsets = _get_lvec(linear_offsets, np.zeros(nlab))[:, 1+nlab:] * 10
     ones = np.ones((Nstars, 1)) * 0.001
     ldelta_vec = np.hstack((ones, linear_offsets, quadratic_offsets))
 
@@ -202,14 +207,15 @@ def _do_one_regression_at_fixed_scatter(lams, fluxes, ivars, lvec, scatter, wl_f
         inverse variance values for all stars at one pixel
 
     lvec: numpy ndarray
-        the label vector
+        the label vector, shared by all pixels and left unmodified
 
     scatter: float
         fixed scatter value
 
     wl_filter: numpy ndarray
         the mask across labels for this particular wavelength
-        length num_labels
+        length num_labels; label vector terms involving a masked label
+        are left out of the fit and get a coefficient of zero
 
     Returns
     ------
@@ -226,22 +232,29 @@ def _do_one_regression_at_fixed_scatter(lams, fluxes, ivars, lvec, scatter, wl_f
         inverse of the log determinant of the cov matrix
     """
     Cinv = ivars / (1 + ivars*scatter**2)
-    if wl_filter != None:
-        expanded_wl_filter = np.array(
-                _get_lvec(wl_filter, np.zeros(len(wl_filter))))[0]
-        mask = expanded_wl_filter.astype(bool)
-        lvec[:,mask] = 0
-    lTCinvl = np.dot(lvec.T, Cinv[:, None] * lvec)
+    nterms = lvec.shape[1]
+    keep = np.ones(nterms, dtype=bool)
+    if wl_filter is not None:
+        keep = _get_term_mask(np.asarray(wl_filter)[:, None])[0]
+    # select the allowed columns rather than zeroing them in place,
+    # so that a single lvec can be shared by all of the pixels
+    if not np.all(keep):
+        lvec = lvec[:, keep]
+    lTCinvl_keep = np.dot(lvec.T, Cinv[:, None] * lvec)
     lTCinvf = np.dot(lvec.T, Cinv * fluxes)
     try:
-        coeff = np.linalg.solve(lTCinvl, lTCinvf)
+        coeff_keep = np.linalg.solve(lTCinvl_keep, lTCinvf)
     except np.linalg.linalg.LinAlgError:
         print("np.linalg.linalg.LinAlgError, do_one_regression_at_fixed_scatter")
-        print(lTCinvl, lTCinvf, lams, fluxes)
-    if not np.all(np.isfinite(coeff)):
+        print(lTCinvl_keep, lTCinvf, lams, fluxes)
+    if not np.all(np.isfinite(coeff_keep)):
         raise RuntimeError('something is wrong with the coefficients')
-    chi = np.sqrt(Cinv) * (fluxes - np.dot(lvec, coeff))
+    chi = np.sqrt(Cinv) * (fluxes - np.dot(lvec, coeff_keep))
     logdet_Cinv = np.sum(np.log(Cinv))
+    coeff = np.zeros(nterms)
+    coeff[keep] = coeff_keep
+    lTCinvl = np.eye(nterms)
+    lTCinvl[np.ix_(keep, keep)] = lTCinvl_keep
     return (coeff, lTCinvl, chi, logdet_Cinv)
 
 
@@ -304,12 +317,445 @@ def _do_one_regression(lams, fluxes, ivars, lvec, wl_filter):
     return _r + (best_scatter, )
 
 
-def _get_lvec(label_vals, pivots, scales, derivs):
+def _cho_solve_stacked(lTCinvl, lTCinvf):
+    """ Solve a stack of symmetric positive-definite systems in one go
+
+    Parameters
+    ----------
+    lTCinvl: numpy ndarray, shape (npix, nterms, nterms)
+        one normal matrix per pixel
+
+    lTCinvf: numpy ndarray, shape (npix, nterms)
+        one right-hand side per pixel
+
+    Returns
+    -------
+    coeffs: numpy ndarray, shape (npix, nterms)
+        solutions of the systems
+
+    chol: numpy ndarray, shape (npix, nterms, nterms)
+        lower Cholesky factors of lTCinvl
+    """
+    try:
+        chol = np.linalg.cholesky(lTCinvl)
+    except np.linalg.LinAlgError:
+        print("np.linalg.LinAlgError, _cho_solve_stacked")
+        raise
+    y = np.linalg.solve(chol, lTCinvf[..., None])
+    coeffs = np.linalg.solve(np.swapaxes(chol, -1, -2), y)[..., 0]
+    return coeffs, chol
+
+
+def _do_regressions_at_fixed_scatter(fluxes, ivars, lvec, lvec_outer,
+                                     scatters, term_mask=None):
+    """ Batched version of _do_one_regression_at_fixed_scatter
+
+    All pixels are solved at once: the normal matrices are formed with a
+    single matrix product against the per-star outer products of lvec.
+
+    Parameters
+    ----------
+    fluxes: numpy ndarray, shape (npix, nstars)
+        flux values for all stars at all pixels
+
+    ivars: numpy ndarray, shape (npix, nstars)
+        inverse variance values, parallel to fluxes
+
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+
+    lvec_outer: numpy ndarray, shape (nstars, nterms*nterms)
+        flattened outer product of lvec with itself, for each star
+
+    scatters: numpy ndarray, shape (npix, )
+        fixed scatter value for each pixel
+
+    term_mask: numpy ndarray, shape (npix, nterms), optional
+        True where a label vector term is allowed at a pixel;
+        disallowed terms get a coefficient of zero
+
+    Returns
+    ------
+    coeffs: ndarray, shape (npix, nterms)
+        coefficients of the fit
+
+    chol: ndarray, shape (npix, nterms, nterms)
+        Cholesky factors of the inverse covariance matrices of the coeffs
+
+    chis: ndarray, shape (npix, nstars)
+        chi at best fit
+
+    logdet_Cinv: ndarray, shape (npix, )
+        log determinant of the inverse covariance matrix of the data
+    """
+    nterms = lvec.shape[1]
+    Cinv = ivars / (1 + ivars*scatters[:, None]**2)
+    lTCinvl = np.dot(Cinv, lvec_outer).reshape(-1, nterms, nterms)
+    lTCinvf = np.dot(Cinv * fluxes, lvec)
+    if term_mask is not None:
+        # decouple the disallowed terms so that their coefficients are zero
+        off = ~term_mask
+        lTCinvl[off[:, :, None] | off[:, None, :]] = 0.
+        diag = np.arange(nterms)
+        lTCinvl[:, diag, diag] = np.where(off, 1., lTCinvl[:, diag, diag])
+        lTCinvf[off] = 0.
+    coeffs, chol = _cho_solve_stacked(lTCinvl, lTCinvf)
+    if not np.all(np.isfinite(coeffs)):
+        raise RuntimeError('something is wrong with the coefficients')
+    chis = np.sqrt(Cinv) * (fluxes - np.dot(coeffs, lvec.T))
+    logdet_Cinv = np.sum(np.log(Cinv), axis=1)
+    return (coeffs, chol, chis, logdet_Cinv)
+
+
+def _do_regressions(fluxes, ivars, lvec, term_mask=None):
+    """
+    Batched version of _do_one_regression: scans the same ln(scatter) grid
+    and applies the same quadratic refinement, but for all pixels at once.
+
+    Input
+    -----
+    fluxes: numpy ndarray, shape (npix, nstars)
+        pixel intensities
+
+    ivars: numpy ndarray, shape (npix, nstars)
+        inverse variances associated with pixel intensities
+
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+
+    term_mask: numpy ndarray, shape (npix, nterms), optional
+        True where a label vector term is allowed at a pixel
+
+    Output
+    -----
+    output of _do_regressions_at_fixed_scatter, plus the best scatters
+    """
+    nstars, nterms = lvec.shape
+    npix = fluxes.shape[0]
+    lvec_outer = (lvec[:, :, None] * lvec[:, None, :]).reshape(nstars, -1)
+    ln_scatter_vals = np.arange(np.log(0.0001), 0., 0.5)
+    step = ln_scatter_vals[1] - ln_scatter_vals[0]
+    nvals = len(ln_scatter_vals)
+    # minimize over the range of scatter possibilities
+    chis_eval = np.zeros((npix, nvals))
+    for jj, ln_scatter_val in enumerate(ln_scatter_vals):
+        scatters = np.exp(ln_scatter_val) * np.ones(npix)
+        coeffs, chol, chis, logdet_Cinv = _do_regressions_at_fixed_scatter(
+                fluxes, ivars, lvec, lvec_outer, scatters, term_mask)
+        chis_eval[:, jj] = np.sum(chis*chis, axis=1) - logdet_Cinv
+    bad = np.any(np.isnan(chis_eval), axis=1)
+    lowest = np.argmin(np.where(np.isnan(chis_eval), np.inf, chis_eval),
+                       axis=1)
+    lowest[bad] = nvals - 1
+    best_ln_scatters = ln_scatter_vals[lowest]
+    # vertex of the parabola through the minimum and its two neighbours
+    interior = ~bad & (lowest > 0) & (lowest < nvals - 1)
+    pix = np.where(interior)[0]
+    y0 = chis_eval[pix, lowest[pix] - 1]
+    y1 = chis_eval[pix, lowest[pix]]
+    y2 = chis_eval[pix, lowest[pix] + 1]
+    curv = y2 - 2.*y1 + y0
+    flat = curv == 0
+    curv[flat] = 1.
+    shift = np.where(flat, 0., 0.5 * step * (y2 - y0) / curv)
+    best_ln_scatters[pix] = best_ln_scatters[pix] - shift
+    best_scatters = np.exp(best_ln_scatters)
+    _r = _do_regressions_at_fixed_scatter(
+            fluxes, ivars, lvec, lvec_outer, best_scatters, term_mask)
+    return _r + (best_scatters, )
+
+
+def _do_regressions_newton(fluxes, ivars, lvec, term_mask=None, tol=1e-4,
+                           max_iter=50):
+    """
+    Optimizes the scatter of all pixels at once with safeguarded Newton
+    steps in ln(scatter), instead of scanning a grid of scatter values.
+
+    The objective is the same as in _do_one_regression, chi^2 minus the log
+    determinant of the inverse data covariance, with the coefficients
+    profiled out. Each iteration does a single factorization per pixel,
+    which gives both the coefficients and the coefficient-response term
+    of the second derivative. Steps that leave the bracket of the minimum
+    fall back to bisection, and each pixel stops once its step is below
+    tol.
+
+    Input
+    -----
+    fluxes: numpy ndarray, shape (npix, nstars)
+        pixel intensities
+
+    ivars: numpy ndarray, shape (npix, nstars)
+        inverse variances associated with pixel intensities
+
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+
+    term_mask: numpy ndarray, shape (npix, nterms), optional
+        True where a label vector term is allowed at a pixel
+
+    tol: float
+        convergence tolerance on ln(scatter)
+
+    max_iter: int
+        maximum number of iterations for each pixel
+
+    Output
+    -----
+    output of _do_regressions_at_fixed_scatter, plus the best scatters
+    and the number of iterations taken by each pixel
+    """
+    nstars, nterms = lvec.shape
+    npix = fluxes.shape[0]
+    lvec_outer = (lvec[:, :, None] * lvec[:, None, :]).reshape(nstars, -1)
+    ln_min, ln_max = np.log(0.0001), 0.
+    lo = ln_min * np.ones(npix)
+    hi = ln_max * np.ones(npix)
+    ln_scatters = np.log(0.01) * np.ones(npix)
+    max_step = 2.
+
+    coeffs = np.zeros((npix, nterms))
+    chol = np.zeros((npix, nterms, nterms))
+    chis = np.zeros(fluxes.shape)
+    logdet_Cinv = np.zeros(npix)
+    niters = np.zeros(npix, dtype=int)
+    active = np.arange(npix)
+    while len(active) > 0:
+        mask = None if term_mask is None else term_mask[active]
+        s2 = np.exp(2.*ln_scatters[active])
+        _r = _do_regressions_at_fixed_scatter(
+                fluxes[active], ivars[active], lvec, lvec_outer,
+                np.sqrt(s2), mask)
+        coeffs[active], chol[active], chis[active], logdet_Cinv[active] = _r
+        niters[active] += 1
+
+        # derivatives of the objective with respect to ln(scatter)
+        ivar = ivars[active]
+        Cinv = ivar / (1 + ivar*s2[:, None])
+        dCinv = -2. * s2[:, None] * Cinv**2
+        d2Cinv = 2. * dCinv - 4. * s2[:, None] * Cinv * dCinv
+        resid2_minus_var = chis[active]**2 / Cinv - 1. / Cinv
+        grad = np.sum(dCinv * resid2_minus_var, axis=1)
+        u = np.dot(dCinv * chis[active] / np.sqrt(Cinv), lvec)
+        if mask is not None:
+            u[~mask] = 0.
+        v = np.linalg.solve(chol[active], u[..., None])[..., 0]
+        hess = np.sum(d2Cinv * resid2_minus_var + (dCinv / Cinv)**2, axis=1) \
+               - 2. * np.sum(v*v, axis=1)
+
+        # shrink the bracket of the minimum using the sign of the gradient
+        theta = ln_scatters[active]
+        hi[active] = np.where(grad > 0, theta, hi[active])
+        lo[active] = np.where(grad < 0, theta, lo[active])
+        newton = hess > 0
+        step = np.where(newton, -grad / np.where(newton, hess, 1.),
+                        -np.sign(grad) * max_step)
+        step = np.clip(step, -max_step, max_step)
+        new_theta = np.clip(theta + step, ln_min, ln_max)
+        # the bounds themselves may be tried, the rest of the bracket edges
+        # have already been evaluated
+        outside = (new_theta < lo[active]) | (new_theta > hi[active]) | \
+                  ((new_theta == lo[active]) & (lo[active] > ln_min)) | \
+                  ((new_theta == hi[active]) & (hi[active] < ln_max))
+        new_theta[outside] = 0.5 * (lo[active] + hi[active])[outside]
+        at_bound = ((theta == ln_min) & (grad > 0)) | \
+                   ((theta == ln_max) & (grad < 0))
+        done = (np.abs(new_theta - theta) < tol) | at_bound | \
+               (hi[active] - lo[active] < tol) | (grad == 0) | \
+               (niters[active] >= max_iter)
+        ln_scatters[active] = np.where(done, theta, new_theta)
+        active = active[~done]
+
+    nfailed = np.sum(niters >= max_iter)
+    if nfailed > 0:
+        print("Warning: scatter did not converge for %s pixels" % nfailed)
+    return (coeffs, chol, chis, logdet_Cinv, np.exp(ln_scatters), niters)
+
+
+# shared arrays mapped by each training worker, see _init_train_worker
+_shared = {}
+
+
+def _init_train_worker(specs, blas_threads):
+    """ Map the shared training arrays in a worker process """
+    limit_blas_threads(blas_threads)
+    for key, spec in specs.items():
+        _shared[key] = SharedArray.attach(spec).array
+
+
+def _train_shard(task):
+    """ Fit one contiguous shard of pixels and write it to the outputs """
+    start, stop, scatter_solver = task
+    term_mask = _shared.get('term_mask')
+    if term_mask is not None:
+        term_mask = term_mask[start:stop]
+    fluxes = _shared['fluxes'][start:stop]
+    ivars = _shared['ivars'][start:stop]
+    if scatter_solver == "newton":
+        coeffs, chol, chis, logdet_Cinv, scatters, niters = \
+                _do_regressions_newton(fluxes, ivars, _shared['lvec'],
+                                       term_mask)
+    else:
+        coeffs, chol, chis, logdet_Cinv, scatters = _do_regressions(
+                fluxes, ivars, _shared['lvec'], term_mask)
+        niters = 0
+    _shared['coeffs'][start:stop] = coeffs
+    _shared['chis'][start:stop] = chis
+    _shared['scatters'][start:stop] = scatters
+    _shared['niters'][start:stop] = niters
+    return start, stop
+
+
+def _do_regressions_parallel(fluxes, ivars, lvec, term_mask=None,
+                             scatter_solver="newton", n_proc=2,
+                             shards_per_proc=4):
+    """
+    Run the batched regressions on contiguous shards of pixels in a pool
+    of worker processes.
+
+    The flux and ivar cubes, the design matrix and the outputs live in
+    shared arrays, so the workers map them instead of receiving pickled
+    copies, and every shard writes its results in place.
+
+    Input
+    -----
+    fluxes: numpy ndarray, shape (npix, nstars)
+        pixel intensities
+
+    ivars: numpy ndarray, shape (npix, nstars)
+        inverse variances associated with pixel intensities
+
+    lvec: numpy ndarray, shape (nstars, nterms)
+        the label vector
+
+    term_mask: numpy ndarray, shape (npix, nterms), optional
+        True where a label vector term is allowed at a pixel
+
+    scatter_solver: str
+        "newton" or "grid", see _train_model
+
+    n_proc: int
+        number of worker processes
+
+    shards_per_proc: int
+        number of shards per process, for load balancing
+
+    Output
+    -----
+    coeffs, chis, scatters and niters for all pixels, in pixel order
+    """
+    npix, nstars = fluxes.shape
+    nterms = lvec.shape[1]
+    inputs = {'fluxes': fluxes, 'ivars': ivars, 'lvec': lvec}
+    if term_mask is not None:
+        inputs['term_mask'] = term_mask
+    shared = dict((key, SharedArray.copy_of(val))
+                  for key, val in inputs.items())
+    shared['coeffs'] = SharedArray((npix, nterms))
+    shared['chis'] = SharedArray((npix, nstars))
+    shared['scatters'] = SharedArray((npix, ))
+    shared['niters'] = SharedArray((npix, ), dtype=int)
+    specs = dict((key, val.spec) for key, val in shared.items())
+
+    nshards = max(1, min(npix, shards_per_proc * n_proc))
+    bounds = np.linspace(0, npix, nshards + 1).astype(int)
+    tasks = [(start, stop, scatter_solver)
+             for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+    blas_threads = blas_threads_per_proc(n_proc)
+    try:
+        with blas_thread_env(blas_threads):
+            pool = mp.Pool(processes=n_proc, initializer=_init_train_worker,
+                           initargs=(specs, blas_threads))
+        try:
+            for start, stop in pool.imap_unordered(_train_shard, tasks):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+        coeffs = np.array(shared['coeffs'].array)
+        chis = np.array(shared['chis'].array)
+        scatters = np.array(shared['scatters'].array)
+        niters = np.array(shared['niters'].array)
+    finally:
+        for val in shared.values():
+            val.release()
+    return coeffs, chis, scatters, niters
+
+
+def _get_term_mask(wl_filter):
+    """ Expand a per-label wavelength filter onto the label vector terms
+
+    Parameters
+    ----------
+    wl_filter: numpy ndarray, shape (nlabels, npix)
+        True where a label may be used to model a pixel
+
+    Returns
+    -------
+    term_mask: numpy ndarray, shape (npix, nterms)
+        True where a label vector term may be used to model a pixel
+    """
+    filt = np.asarray(wl_filter, dtype=float).T
+    nlabels = filt.shape[1]
+    return _get_lvec(filt, np.zeros(nlabels)) != 0
+
+
+# monomial index tables of the label vector, keyed by (nlabels, order)
+_lvec_tables = {}
+
+
+def _get_lvec_tables(nlabels, order):
+    """
+    Index tables describing the monomials of the label vector
+
+    The terms are ordered as the constant, the linear terms, then the
+    products of each higher degree in np.triu_indices order. Index nlabels
+    points at a column of ones, used to pad lower-degree terms.
+
+    Parameters
+    ----------
+    nlabels: int
+        number of labels
+    order: int
+        highest degree of the polynomial model
+
+    Returns
+    -------
+    term_idx: numpy ndarray, shape (nterms, order)
+        labels multiplied together in each term
+    deriv_idx: numpy ndarray, shape (nterms, nlabels, order-1)
+        labels multiplied together in the derivative of each term
+        with respect to each label
+    deriv_mult: numpy ndarray, shape (nterms, nlabels)
+        multiplicity of each label in each term
+    """
+    key = (nlabels, order)
+    if key not in _lvec_tables:
+        terms = [()]
+        for degree in range(1, order+1):
+            terms.extend(combinations_with_replacement(range(nlabels), degree))
+        nterms = len(terms)
+        term_idx = np.zeros((nterms, order), dtype=int) + nlabels
+        deriv_idx = np.zeros((nterms, nlabels, max(order-1, 0)),
+                             dtype=int) + nlabels
+        deriv_mult = np.zeros((nterms, nlabels))
+        for t, term in enumerate(terms):
+            term_idx[t, :len(term)] = term
+            for k in set(term):
+                reduced = list(term)
+                reduced.remove(k)
+                deriv_idx[t, k, :len(reduced)] = reduced
+                deriv_mult[t, k] = term.count(k)
+        _lvec_tables[key] = (term_idx, deriv_idx, deriv_mult)
+    return _lvec_tables[key]
+
+
+def _get_lvec(label_vals, pivots, scales=None, derivs=False, order=2):
     """
     Constructs a label vector for an arbitrary number of labels
-    Assumes that our model is quadratic in the labels
-    
-    Comment: this is really slow, but we will only have to compute it once!
+    Assumes that our model is polynomial (by default quadratic) in the labels
+
+    The monomials are filled by broadcasting over precomputed index
+    tables, so this is fast for any number of stars.
 
     Parameters
     ----------
@@ -318,8 +764,9 @@ def _get_lvec(label_vals, pivots, scales, derivs):
     pivots: numpy ndarray, shape (nlabels, )
         offset we subtract from the label_vals
     scales: numpy ndarray, shape (nlabels, )
-        scale we divide out of the label_vals
+        scale we divide out of the label_vals, ones if None
     derivs: return also the derivatives of the vector wrt the labels
+    order: highest degree of the polynomial model
 
     Returns
     -------
@@ -332,34 +779,29 @@ def _get_lvec(label_vals, pivots, scales, derivs):
     --------
     lvec_derivs and lvec is now in units of the scaled labels! 
     """
+    label_vals = np.asarray(label_vals, dtype=float)
     if len(label_vals.shape) == 1:
         label_vals = np.array([label_vals])
-    nlabels = label_vals.shape[1]
-    nstars = label_vals.shape[0]
-    # specialized to second-order model
+    nstars, nlabels = label_vals.shape
+    if scales is None:
+        scales = np.ones(nlabels)
+    term_idx, deriv_idx, deriv_mult = _get_lvec_tables(nlabels, order)
     linear_offsets = (label_vals - pivots[None, :]) / scales[None, :]
-    quadratic_offsets = np.array([np.outer(m, m)[np.triu_indices(nlabels)]
-                                  for m in (linear_offsets)])
-    ones = np.ones((nstars, 1))
-    lvec = np.hstack((ones, linear_offsets, quadratic_offsets))
+    # extra column of ones pads the lower-degree terms
+    offsets = np.hstack((linear_offsets, np.ones((nstars, 1))))
+    lvec = offsets[:, term_idx[:, 0]]
+    for j in range(1, order):
+        lvec *= offsets[:, term_idx[:, j]]
     if not derivs:
         return lvec
-    ones_derivs = np.zeros((nstars, 1, nlabels))
-    linear_derivs = np.zeros((nstars, nlabels, nlabels))
-    for i in range(nstars):
-        linear_derivs[i] = np.eye(nlabels) 
-    quadratic_derivs = np.zeros((nstars, len(quadratic_offsets[1]), nlabels))
-    for n in range(nstars):
-        for k in range(nlabels): 
-            foo = np.zeros((nlabels, nlabels))
-            foo[k, :] = linear_offsets[n]
-            foo[:, k] = linear_offsets[n]
-            quadratic_derivs[n, :, k] = np.array(foo[np.triu_indices(nlabels)]) 
-    lvec_derivs = np.hstack((ones_derivs, linear_derivs, quadratic_derivs))
-    
+    lvec_derivs = np.empty((nstars, ) + deriv_mult.shape)
+    lvec_derivs[:] = deriv_mult
+    for j in range(order-1):
+        lvec_derivs *= offsets[:, deriv_idx[:, :, j]]
     return lvec, lvec_derivs
 
-def _train_model(ds, wl_filter):
+def _train_model(ds, wl_filter=None, backend="batched", scatter_solver="newton",
+                 n_proc=1):
     """
     This determines the coefficients of the model using the training data
 
@@ -368,6 +810,16 @@ def _train_model(ds, wl_filter):
     ds: Dataset
     wl_filter (optional): if not None, is an array of n_tr_lab x n_pixels
         that dictates which pixels can be used in the model for each label
+    backend (optional): str
+        "batched" solves all pixels at once with stacked linear algebra,
+        "pixel" solves one pixel at a time
+    scatter_solver (optional): str
+        "newton" optimizes the scatters with safeguarded Newton steps,
+        "grid" scans a grid of ln(scatter) values (the "pixel" backend
+        only supports "grid")
+    n_proc (optional): int
+        number of processes; the batched backend splits the pixels into
+        contiguous shards that are fit in parallel
 
     Returns
     -------
@@ -379,30 +831,63 @@ def _train_model(ds, wl_filter):
     lams = ds.wl
     npixels = len(lams)
     fluxes = ds.tr_flux
-    ivars = ds.tr_ivar
     
     # for training, ivar can't be zero, otherwise you get singular matrices
     # DWH says: make sure no ivar goes below 1 or 0.01
-    ivars[ivars<0.01] = 0.01
+    # clip a copy: ds.tr_ivar may be read-only or mapped from a file
+    ivars = np.maximum(ds.tr_ivar, 0.01)
 
     pivots, scales = get_pivots_and_scales(label_vals)
     lvec = _get_lvec(label_vals, pivots, scales, derivs=False)
-    lvec_full = np.array([lvec,] * npixels)
+    # one design matrix for all pixels, never written to
+    lvec.setflags(write=False)
 
     # Perform REGRESSIONS
-    fluxes = fluxes.swapaxes(0,1)  # for consistency with lvec_full
+    fluxes = fluxes.swapaxes(0,1)  # for consistency with lvec
     ivars = ivars.swapaxes(0,1)
-    
-    # one per pix
-    blob = list(map(
-        _do_one_regression, lams, fluxes, ivars, lvec_full, wl_filter.T))
-    coeffs = np.array([b[0] for b in blob])
-    covs = np.array([np.linalg.inv(b[1]) for b in blob])
-    chis = np.array([b[2] for b in blob])
-    scatters = np.array([b[4] for b in blob])
+
+    if backend == "batched":
+        term_mask = None
+        if wl_filter is not None:
+            term_mask = _get_term_mask(wl_filter)
+        if scatter_solver not in ("newton", "grid"):
+            raise ValueError("unknown scatter solver: %s" % scatter_solver)
+        if n_proc > 1:
+            coeffs, chis, scatters, niters = _do_regressions_parallel(
+                    fluxes, ivars, lvec, term_mask, scatter_solver, n_proc)
+        elif scatter_solver == "newton":
+            coeffs, chol, chis, logdet_Cinv, scatters, niters = \
+                    _do_regressions_newton(fluxes, ivars, lvec, term_mask)
+        else:
+            coeffs, chol, chis, logdet_Cinv, scatters = _do_regressions(
+                    fluxes, ivars, lvec, term_mask)
+    elif backend == "pixel":
+        if scatter_solver != "grid":
+            raise ValueError("the pixel backend only supports the grid scan")
+        if n_proc > 1:
+            raise ValueError("n_proc > 1 requires the batched backend")
+        if wl_filter is None:
+            wl_filter = repeat(None)
+        else:
+            wl_filter = wl_filter.T
+        # one per pix
+        blob = list(map(
+            _do_one_regression, lams, fluxes, ivars, repeat(lvec), wl_filter))
+        coeffs = np.array([b[0] for b in blob])
+        covs = np.array([np.linalg.inv(b[1]) for b in blob])
+        chis = np.array([b[2] for b in blob])
+        scatters = np.array([b[4] for b in blob])
+    else:
+        raise ValueError("unknown training backend: %s" % backend)
+    if scatter_solver == "grid":
+        # one regression per grid point, plus one at the refined scatter
+        nvals = len(np.arange(np.log(0.0001), 0., 0.5))
+        niters = (nvals + 1) * np.ones(npixels, dtype=int)
+    print("Scatter solves per pixel: mean %.1f, max %s"
+          % (np.mean(niters), np.max(niters)))
 
     # Calc chi sq
     all_chisqs = chis*chis
     print("Done training model. ")
 
-    return coeffs, scatters, all_chisqs, pivots, scales
+    return coeffs, scatters, all_chisqs, pivots, scales, niters
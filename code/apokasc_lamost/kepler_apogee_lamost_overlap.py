@@ -1,5 +1,6 @@
 import numpy as np
 import os
+from TheCannon.join import match_ids
 
 # APOGEE-APOKASC overlap
 
@@ -16,7 +17,7 @@ apogee_lamost = np.array(os.listdir(inputf))
 overlap = np.intersect1d(apogee_lamost, apogee_apokasc) # 530 stars
 apogee_key = np.loadtxt("apogee_sorted_by_ra.txt", dtype=str)
 lamost_key = np.loadtxt("lamost_sorted_by_ra.txt", dtype=str)
-inds = np.array([np.where(apogee_key==a)[0][0] for a in overlap])
+inds = match_ids(apogee_key, overlap)
 overlap_lamost = lamost_key[inds]
 
 np.savez("apogee_apokasc_lamost_overlap.npz", overlap)
@@ -27,7 +28,7 @@ label_file = "apogee_dr12_labels.csv"
 apogee_id_all = np.loadtxt(label_file, usecols=(1,), delimiter=',', dtype=str)
 apogee_labels_all = np.loadtxt(
         label_file, usecols=(2,3,4,5), delimiter=',', dtype=float)
-inds = np.array([np.where(apogee_id_all==a)[0][0] for a in overlap])
+inds = match_ids(apogee_id_all, overlap)
 apogee_id = apogee_id_all[inds]
 apogee_labels = apogee_labels_all[inds,:]
 
@@ -36,7 +37,7 @@ apogee_labels = apogee_labels_all[inds,:]
 
 apokasc_id_all = np.load("example_apokasc/apokasc_DR12_overlap.npz")['arr_0']
 apokasc_labels_all = np.load("example_apokasc/tr_label.npz")['arr_0']
-inds = np.array([np.where(apokasc_id_all==a)[0][0] for a in overlap])
+inds = match_ids(apokasc_id_all, overlap)
 apokasc_id = apokasc_id_all[inds]
 apokasc_labels = apokasc_labels_all[inds]
 
@@ -46,7 +47,7 @@ apokasc_labels = apokasc_labels_all[inds]
 inputf = "/home/annaho/TheCannon/examples/test_training_overlap/lamost_sorted_by_ra_with_dr2_params.txt"
 lamost_id_all = np.loadtxt(inputf, usecols=(0,), dtype=str)
 lamost_labels_all = np.loadtxt(inputf, usecols=(3,4,5), dtype=float)
-inds = np.array([np.where(lamost_id_all==a)[0][0] for a in overlap_lamost])
+inds = match_ids(lamost_id_all, overlap_lamost)
 lamost_id = lamost_id_all[inds]
 lamost_labels = lamost_labels_all[inds]
 
@@ -4,14 +4,13 @@ overlaid with our "gradient spectra" from The Cannon """
 import numpy as np
 import matplotlib.pyplot as plt
 import pyfits
-import copy
 from matplotlib import rc
 from scipy import interpolate 
 rc('font', family='serif')
 rc('text', usetex=True)
 from matplotlib import cm
 from matplotlib.colors import LogNorm
-from TheCannon import train_model
+from TheCannon import synthesis
 from TheCannon import continuum_normalization
 
 
@@ -78,20 +77,18 @@ def gen_cannon_grad_spec(choose, coeffs, pivots):
             [0, 1, -1, 13, 20, 6, 26, 12, 25, 28, 7, 8, 14, 22])
     # Generate Cannon gradient spectra
     ind = np.where(label_atnum==choose)[0][0]
-    low_lab = copy.copy(base_labels)
     high = base_labels[ind]
     if choose > 0:
         low = base_labels[ind] - 0.2
     else: #temperature
         if choose != 0: print("warning...")
         low = base_labels[ind] - 200
-    low_lab[ind] = low
-    lvec = (train_model._get_lvec(np.array([low_lab]), pivots))[0]
-    model_low = np.dot(coeffs, lvec)
-    lvec = (train_model._get_lvec(np.array([base_labels]), pivots))[0]
-    model_high = np.dot(coeffs, lvec)
-    grad_spec = (model_high - model_low) / (high - low)
-    return grad_spec
+    # the model is quadratic, so the slope between low and high is the
+    # gradient at their midpoint
+    mid_lab = np.array(base_labels, dtype=float)
+    mid_lab[ind] = 0.5 * (low + high)
+    grad_spec = synthesis._gradient_spectra(coeffs, mid_lab, pivots)
+    return grad_spec[0, :, ind]
 
 
 def get_model_spec_martell():
@@ -12,6 +12,7 @@ import sys
 sys.path.append("/home/annaho/TheCannon")
 from TheCannon import lamost
 from TheCannon import dataset
+from TheCannon.join import match_ids
 from model_spectra import get_model_spec
 from model_spectra import spectral_model
 
@@ -72,15 +73,10 @@ def get_labels(ids_find):
     afe = data['cannon_alpha_m']
     ak = data['cannon_a_k']
     labels = np.vstack((teff,logg,feh,afe,ak))
-    choose = np.in1d(id_all, ids_find)
-    id_choose = id_all[choose]
-    label_choose = labels[:,choose]
-    snr_choose = snr_all[choose]
-    chisq_choose = chisq_all[choose]
-    inds = np.array([np.where(id_choose==val)[0][0] for val in ids_find])
-    print(id_choose[inds][100])
+    inds = match_ids(id_all, ids_find)
+    print(id_all[inds][100])
     print(ids_find[100])
-    return label_choose[:,inds], snr_choose[inds], chisq_choose[inds]
+    return labels[:,inds], snr_all[inds], chisq_all[inds]
 
 
 def get_normed_spectra():
@@ -35,9 +35,7 @@ def get_residuals(ds, m):
     ------
     residuals: array of residuals, spec minus model spec
     """
-    model_spectra = get_model_spectra(ds, m)
-    resid = ds.test_flux - model_spectra
-    return resid
+    return m.infer_spectra(ds, outputs=("resid", ))["resid"]
 
 
 def get_model_spectra(ds, m):
@@ -151,8 +149,9 @@ def run_one_date(date):
     print("%s obj" %nobj)
     inds = np.arange(nobj)
     m = load_model()
-    model_spec = get_model_spectra(ds, m)
-    resid = get_residuals(ds, m)
+    spectra = m.infer_spectra(ds, outputs=("model", "resid"))
+    model_spec = spectra["model"]
+    resid = spectra["resid"]
 
     print("get data to fit")
     x,y,yerr = get_data_to_fit(ds,m,resid)
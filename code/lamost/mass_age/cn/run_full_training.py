@@ -12,6 +12,7 @@ import pyfits
 from TheCannon import dataset
 from TheCannon import model
 from TheCannon import lamost
+from TheCannon.join import match_ids
 from astropy.table import Table
 from matplotlib.colors import LogNorm
 from matplotlib import rc
@@ -71,7 +72,7 @@ def load_data():
     all_id = np.load("%s/tr_id.npz" %SPEC_DIR)['arr_0'].astype(str)
     all_flux = np.load("%s/tr_flux.npz" %SPEC_DIR)['arr_0']
     all_ivar = np.load("%s/tr_ivar.npz" %SPEC_DIR)['arr_0']
-    choose = np.array([np.where(all_id==f)[0][0] for f in ref_id])
+    choose = match_ids(all_id, ref_id)
     flux = all_flux[choose,:]
     ivar = all_ivar[choose,:]
     np.savez("ref_flux.npz", flux)
@@ -4,13 +4,12 @@ overlaid with our "gradient spectra" from The Cannon """
 import numpy as np
 import matplotlib.pyplot as plt
 import pyfits
-import copy
 from matplotlib import rc
 rc('font', family='serif')
 rc('text', usetex=True)
 from matplotlib import cm
 from matplotlib.colors import LogNorm
-from TheCannon import train_model
+from TheCannon import synthesis
 from TheCannon import continuum_normalization
 
 
@@ -62,17 +61,12 @@ def gen_cannon_grad_spec(base_labels, choose, low, high, coeffs, pivots):
     low: lowest val of cfe or nfe, whatever you're varying
     high: highest val of cfe or nfe, whatever you're varying
     """
-    # Generate Cannon gradient spectra
-    low_lab = copy.copy(base_labels)
-    low_lab[choose] = low
-    lvec = (train_model._get_lvec(np.array([low_lab]), pivots))[0]
-    model_low = np.dot(coeffs, lvec)
-    high_lab = copy.copy(base_labels)
-    high_lab[choose] = high
-    lvec = (train_model._get_lvec(np.array([high_lab]), pivots))[0]
-    model_high = np.dot(coeffs, lvec)
-    grad_spec = (model_high - model_low) / (high - low)
-    return grad_spec
+    # Generate Cannon gradient spectra: the model is quadratic, so the
+    # slope between low and high is the gradient at their midpoint
+    mid_lab = np.array(base_labels, dtype=float)
+    mid_lab[choose] = 0.5 * (low + high)
+    grad_spec = synthesis._gradient_spectra(coeffs, mid_lab, pivots)
+    return grad_spec[0, :, choose]
 
 
 def get_model_spec_martell():
@@ -1,8 +1,15 @@
 """ Generate model spectra, add model attribute """
+import numpy as np
+from TheCannon.synthesis import _synthesize
+from TheCannon.helpers.cubes import new_array, iter_blocks
 
-def draw_spectra(md, ds):
+def draw_spectra(md, ds, out_dir=None, block_size=1000):
     """ Generate best-fit spectra for all the test objects  
 
+    The spectra are written a block of stars at a time; with an out_dir
+    they are memory-mapped there as model_spectra.npy and model_ivar.npy
+    instead of held in memory.
+
     Parameters
     ----------
     md: model
@@ -11,24 +18,29 @@ def draw_spectra(md, ds):
     ds: Dataset 
         Dataset object
 
+    out_dir: str, optional
+        directory of the outputs; that of the dataset if None
+
+    block_size: int
+        number of stars computed at once
+
     Returns
     -------
     best_fluxes: ndarray 
         The best-fit test fluxes
 
     best_ivars:
-        The best-fit test inverse variances
+        The best-fit test inverse variances, zero where the test ivar is
     """
-    coeffs_all, covs, scatters, red_chisqs, pivots, label_vector = model.model
-    nstars = len(dataset.test_SNR)
-    cannon_flux = np.zeros(dataset.test_flux.shape)
-    cannon_ivar = np.zeros(dataset.test_ivar.shape)
-    for i in range(nstars):
-        x = label_vector[:,i,:]
-        spec_fit = np.einsum('ij, ij->i', x, coeffs_all)
-        cannon_flux[i,:] = spec_fit
-        bad = dataset.test_ivar[i,:] == SMALL**2
-        cannon_ivar[i,:][~bad] = 1. / scatters[~bad] ** 2
+    if out_dir is None:
+        out_dir = getattr(ds, 'out_dir', None)
+    cannon_flux = _synthesize(md, ds.test_label_vals, outputs=("model", ),
+                              out_dir=out_dir, block_size=block_size)["model"]
+    cannon_ivar = new_array(cannon_flux.shape, out_dir, "model_ivar")
+    model_ivar = 1. / md.scatters ** 2
+    for start, stop in iter_blocks(len(cannon_ivar), block_size):
+        good = np.asarray(ds.test_ivar[start:stop]) > 0
+        cannon_ivar[start:stop] = np.where(good, model_ivar, 0.)
     return cannon_flux, cannon_ivar
 
 